@@ -1,7 +1,5 @@
-import simplejson
-import struct
-import socket
-
+from lazymodule import LazyModule, mark_started
 from datacontainer import DataContainer
 from senderexception import SenderException
 from senderprotocol import SenderProtocol
+from probecache import ProbeCache
@@ -1,32 +1,89 @@
 import simplejson
+import tempfile
 import time
 
 from senderprotocol import SenderProtocol
 
 class DataContainer(SenderProtocol):
 
-    def __init__(self, data_type=None, zbx_host="", zbx_port=10051):
+    def __init__(self, data_type=None, zbx_host="", zbx_port=10051,
+                 max_items=None):
         super( DataContainer, self).__init__()
         self.request = "sender data"
         self.zbx_host = zbx_host
         self.zbx_port = zbx_port
         self.items_list = []
         self.data_type = data_type
+        self.clock = None
+        self.max_items = max_items
+        self.spool = None
+        self.spool_len = 0
 
     def set_type(self, data_type):
         if data_type == "lld" or data_type == "items":
             self.data_type = data_type
 
-    def add_item(self, host, key, value, clock=None):
+    def set_max_items(self, max_items):
+        """ Cap the number of items kept in memory. Past the cap, items are
+            spilled to a temporary file and streamed back on send. """
+        self.max_items = max_items
+
+    def set_clock(self, clock=None):
+        """ Stamp the current collection once. Every item added without
+            an explicit clock shares this stamp, until the next send. """
+        if clock is None:
+            clock = time.time()
+        self.clock = int(clock)
+
+    def add_item(self, host, key, value, clock=None, ns=None):
         if clock is None:
-            clock = int((time.time())/60*60)
+            if self.clock is None:
+                self.set_clock()
+            clock = self.clock
+        elif isinstance(clock, float):
+            ''' Sub-second timestamp: split it into clock and ns '''
+            if ns is None:
+                ns = int((clock - int(clock)) * 1000000000)
+            clock = int(clock)
         if self.data_type == "items":
             item = { "host": host, "key": key,
                      "value": value, "clock": clock}
         elif self.data_type == "lld":
             item = { "host": host, "key": key, "clock": clock,
                      "value": simplejson.dumps({"data":value}) }
+        if ns is not None:
+            item["ns"] = ns
         self.items_list.append(item)
+        if self.max_items and len(self.items_list) >= self.max_items:
+            self._spill()
+
+    def _spill(self):
+        """ Append in-memory items to the spool as comma separated JSON,
+            one item per line, which is the body of the payload data list """
+        if self.spool is None:
+            self.spool = tempfile.TemporaryFile()
+        self.spool.seek(0, 2)
+        for item in self.items_list:
+            line = simplejson.dumps(item)
+            if self.spool_len:
+                line = ',\n' + line
+            self.spool.write(line)
+            self.spool_len += len(line)
+        self.items_list = []
+
+    def flush_spool(self):
+        self._spill()
+        return (self.spool, self.spool_len)
+
+    def iter_items(self):
+        """ Yield items one at a time, reading spilled ones back from the
+            spool line by line """
+        if self.spool is not None:
+            self.spool.seek(0)
+            for line in self.spool:
+                yield simplejson.loads(line.rstrip('\n').rstrip(','))
+        for item in self.items_list:
+            yield item
 
     def add(self, data):
         for host in data:
@@ -35,4 +92,21 @@ class DataContainer(SenderProtocol):
                     self.add_item( host, key, data[host][key])
 
     def get_items_list(self):
-        return self.items_list
+        """ Kept for compatibility, builds the whole list in memory.
+            Prefer iter_items. """
+        return list(self.iter_items())
+
+    def reset(self):
+        """ Forget every item, spilled or not, and the collection clock,
+            once they have been sent """
+        self.clock = None
+        if self.spool is not None:
+            self.spool.close()
+        self.spool = None
+        self.spool_len = 0
+        self.items_list = []
+
+    def send(self, container):
+        zbx_answer = super(DataContainer, self).send(container)
+        container.reset()
+        return zbx_answer
@@ -0,0 +1,112 @@
+import atexit
+import os
+import sys
+import time
+
+PROFILE_ENV = 'PROTOBIX_PROFILE_IMPORTS'
+BUDGET_ENV = 'PROTOBIX_STARTUP_BUDGET'
+ZBX_DBG_IMPORT_TIME = "DBG - Import time [%8.2f ms] for [%s]"
+ZBX_DBG_IMPORT_TOTAL = "DBG - Startup time [%8.2f ms], budget [%s ms]"
+ZBX_DBG_IMPORT_SUM = "DBG - Startup not marked, sum of import times [%8.2f ms]"
+ZBX_DBG_IMPORT_DEFERRED = "DBG - Lazy imports after startup mark [%8.2f ms]"
+
+def _get_process_start_time():
+    """ Process start time, from /proc on Linux. Falls back on protobix
+        import time, which misses imports done before it. """
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            ''' Fields after the command name, which may contain spaces:
+                starttime (field 22) is the 20th one '''
+            ticks = float(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as f:
+            uptime = float(f.read().split()[0])
+        return time.time() - uptime + ticks / os.sysconf('SC_CLK_TCK')
+    except (IOError, OSError, ValueError, IndexError):
+        return time.time()
+
+import_times = {}
+start_time = _get_process_start_time()
+startup_time = None
+deferred_time = 0
+
+def mark_started():
+    """ Mark the end of startup, right before collection begins.
+        Startup budget is checked against the time elapsed until then,
+        plus LazyModule imports deferred past this mark. """
+    global startup_time
+    if startup_time is None:
+        startup_time = (time.time() - start_time) * 1000
+
+class LazyModule(object):
+    """ Defer a module import until one of its attributes is used.
+
+    mysql = LazyModule('mysql.connector') behaves like
+    'import mysql.connector': the top-level package is returned by
+    __import__, with the requested submodule loaded.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        global deferred_time
+        if self._module is None:
+            clock = time.time()
+            module = __import__(self._name)
+            elapsed = (time.time() - clock) * 1000
+            import_times[self._name] = elapsed
+            if startup_time is not None:
+                ''' Deferred past mark_started, still a startup cost '''
+                deferred_time += elapsed
+            self.__dict__['_module'] = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        if self._module is None:
+            return "<lazy module '%s' (not loaded)>" % self._name
+        return "<lazy module '%s'>" % self._name
+
+def _profiled_import(builtin_import):
+    def profiled_import(name, *args, **kwargs):
+        if name in sys.modules:
+            return builtin_import(name, *args, **kwargs)
+        clock = time.time()
+        module = builtin_import(name, *args, **kwargs)
+        elapsed = (time.time() - clock) * 1000
+        import_times[name] = import_times.get(name, 0) + elapsed
+        return module
+    return profiled_import
+
+def report_import_times(stream=None):
+    if stream is None:
+        stream = sys.stderr
+    for name, elapsed in sorted(import_times.items(),
+                                key=lambda item: item[1],
+                                reverse=True):
+        stream.write((ZBX_DBG_IMPORT_TIME % (elapsed, name)) + '\n')
+    total = startup_time
+    if total is None:
+        total = sum(import_times.values())
+        stream.write((ZBX_DBG_IMPORT_SUM % total) + '\n')
+    else:
+        stream.write((ZBX_DBG_IMPORT_DEFERRED % deferred_time) + '\n')
+        total += deferred_time
+    budget = os.environ.get(BUDGET_ENV, '-')
+    stream.write((ZBX_DBG_IMPORT_TOTAL % (total, budget)) + '\n')
+    if budget != '-' and total > float(budget):
+        stream.write("WARN - Startup budget exceeded\n")
+
+def enable_import_profile():
+    import __builtin__
+    __builtin__.__import__ = _profiled_import(__builtin__.__import__)
+    atexit.register(report_import_times)
+
+if os.environ.get(PROFILE_ENV):
+    enable_import_profile()
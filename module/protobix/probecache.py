@@ -0,0 +1,127 @@
+import errno
+import hashlib
+import os
+import simplejson
+import stat
+import tempfile
+import time
+
+ZBX_CACHE_DIRS = [ '/dev/shm', tempfile.gettempdir() ]
+ZBX_CACHE_CLEANUP_INTERVAL = 3600
+
+class ProbeCache(object):
+    """ Short-lived cache of raw upstream responses, shared between
+    discovery and metrics runs of the same probe.
+
+    Each source has its own TTL in seconds; sources without TTL (or with
+    a TTL of 0) are never cached. Entries are JSON files, so cached values
+    must be JSON serializable. instance tells apart several monitored
+    targets of a same probe (host, socket path...).
+
+    Entries live in a private (0700) per-user subdirectory of cache_dir,
+    and only files owned by the current user are trusted. Entries older
+    than the largest TTL of the probe are removed, at most once per
+    ZBX_CACHE_CLEANUP_INTERVAL.
+    """
+
+    def __init__(self, probe_name, ttls=None, instance='', cache_dir=None):
+        self.probe_name = probe_name
+        self.instance = instance
+        self.ttls = ttls or {}
+        if cache_dir is None:
+            for cache_dir in ZBX_CACHE_DIRS:
+                if os.access(cache_dir, os.W_OK):
+                    break
+        self.cache_dir = self._get_private_dir(cache_dir)
+        if self.cache_dir is not None:
+            self._cleanup()
+
+    def _get_private_dir(self, cache_dir):
+        """ Return a 0700 subdirectory owned by the current user, or None
+            (caching disabled) if it cannot be trusted """
+        path = os.path.join(cache_dir, 'protobix-%d' % os.getuid())
+        try:
+            os.mkdir(path, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                return None
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+                stat.S_IMODE(st.st_mode) & 0077:
+            return None
+        return path
+
+    def _path(self, source, key):
+        digest = hashlib.md5('%s:%s:%s' % (self.instance, source, key))
+        digest = digest.hexdigest()
+        return os.path.join(self.cache_dir,
+                            'protobix-%s-%s.json' % (self.probe_name, digest))
+
+    def _cleanup(self):
+        """ Remove this probe's entries which expired for every source """
+        max_age = max(self.ttls.values() or [0])
+        if not max_age:
+            return
+        stamp = os.path.join(self.cache_dir,
+                             'protobix-%s.cleanup' % self.probe_name)
+        now = time.time()
+        try:
+            if now - os.stat(stamp).st_mtime < ZBX_CACHE_CLEANUP_INTERVAL:
+                return
+        except OSError:
+            pass
+        try:
+            open(stamp, 'w').close()
+            prefix = 'protobix-%s-' % self.probe_name
+            for name in os.listdir(self.cache_dir):
+                if not name.startswith(prefix):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                if now - os.stat(path).st_mtime > max_age:
+                    os.unlink(path)
+        except (IOError, OSError):
+            pass
+
+    def get(self, source, key=''):
+        ttl = self.ttls.get(source, 0)
+        if not ttl or self.cache_dir is None:
+            return None
+        path = self._path(source, key)
+        try:
+            with open(path, 'r') as f:
+                st = os.fstat(f.fileno())
+                if st.st_uid != os.getuid():
+                    return None
+                if time.time() - st.st_mtime > ttl:
+                    return None
+                return simplejson.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def set(self, source, value, key=''):
+        if not self.ttls.get(source, 0) or self.cache_dir is None:
+            return
+        path = self._path(source, key)
+        tmp_path = None
+        try:
+            (fd, tmp_path) = tempfile.mkstemp(dir=self.cache_dir,
+                                              prefix='protobix-tmp-')
+            with os.fdopen(fd, 'w') as f:
+                simplejson.dump(value, f)
+            os.rename(tmp_path, path)
+        except (IOError, OSError, TypeError, ValueError):
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def fetch(self, source, func, *args, **kwargs):
+        """ Return cached value for source, calling func on cache miss.
+            Positional args also discriminate entries of a same source. """
+        key = ','.join([ str(arg) for arg in args ])
+        value = self.get(source, key)
+        if value is None:
+            value = func(*args, **kwargs)
+            self.set(source, value, key)
+        return value
@@ -11,15 +11,38 @@ ZBX_HDR = "ZBXD\1"
 ZBX_HDR_SIZE = 13
 ZBX_RESP_REGEX = r'processed: (\d+); failed: (\d+); total: (\d+); seconds spent: (\d\.\d+)'
 ZBX_DBG_SEND_RESULT = "DBG - Send result [%s] for [%s %s %s]"
-
-def recv_all(sock):
-    buf = ''
-    while len(buf)<ZBX_HDR_SIZE:
-        chunk = sock.recv(ZBX_HDR_SIZE-len(buf))
-        if not chunk:
-            return buf
-        buf += chunk
-    return buf
+ZBX_SPOOL_CHUNK = 65536
+ZBX_MAX_RESPONSE = 8 * 1024 * 1024
+
+def recv_into_all(sock, view):
+    """ Fill view from sock, return number of bytes actually received """
+    received = 0
+    size = len(view)
+    while received < size:
+        nbytes = sock.recv_into(view[received:], size - received)
+        if not nbytes:
+            break
+        received += nbytes
+    return received
+
+def recv_frame(sock):
+    """ Read one ZBXD frame from sock and return its body as a bytearray
+
+    Header and body are read into preallocated buffers, so that large
+    replies are neither copied chunk by chunk nor truncated. The body
+    length comes from the peer, so it is capped before allocating.
+    """
+    header = bytearray(ZBX_HDR_SIZE)
+    if recv_into_all(sock, memoryview(header)) != ZBX_HDR_SIZE or \
+       not header.startswith(ZBX_HDR):
+        raise SenderException("Wrong zabbix response")
+    body_len = struct.unpack_from('<Q', header, len(ZBX_HDR))[0]
+    if body_len > ZBX_MAX_RESPONSE:
+        raise SenderException("Zabbix response too large (%d bytes)" % body_len)
+    body = bytearray(body_len)
+    if recv_into_all(sock, memoryview(body)) != body_len:
+        raise SenderException("Truncated zabbix response")
+    return body
 
 class SenderProtocol(object):
 
@@ -52,31 +75,32 @@ class SenderProtocol(object):
                                   "request": self.request,
                                   "clock": int(time.time()) })
 
-    def send_to_zabbix(self, data):
-        data_len =  struct.pack('<Q', len(data))
-        packet = ZBX_HDR + data_len + data
+    def send_to_zabbix(self, data, data_len=None):
+        """ data is either a string, or an iterable of strings whose total
+            size is data_len """
+        if data_len is None:
+            data_len = len(data)
+            data = [ data ]
+        packet = ZBX_HDR + struct.pack('<Q', data_len)
 
         try:
             zbx_sock = socket.socket()
             zbx_sock.connect((self.zbx_host, int(self.zbx_port)))
-            zbx_sock.sendall(packet)
+            for chunk in data:
+                zbx_sock.sendall(packet + chunk)
+                packet = ''
         except (socket.gaierror, socket.error) as e:
             zbx_sock.close()
             raise SenderException(e[1])
         else:
             try:
-                zbx_srv_resp_hdr = recv_all(zbx_sock)
-                zbx_srv_resp_body_len = struct.unpack('<Q', zbx_srv_resp_hdr[5:])[0]
-                zbx_srv_resp_body = zbx_sock.recv(zbx_srv_resp_body_len)
-                zbx_sock.close()
-            except:
+                zbx_srv_resp_body = recv_frame(zbx_sock)
+            except socket.error:
+                raise SenderException("Error while sending data to Zabbix")
+            finally:
                 zbx_sock.close()
-                if not zbx_srv_resp_hdr.startswith(ZBX_HDR) or len(zbx_srv_resp_hdr) != ZBX_HDR_SIZE:
-                    raise SenderException("Wrong zabbix response")
-                else:
-                    raise SenderException("Error while sending data to Zabbix")
 
-        return simplejson.loads(zbx_srv_resp_body)
+        return simplejson.loads(str(zbx_srv_resp_body))
 
     def send(self, container):
         if self.debug:
@@ -85,19 +109,44 @@ class SenderProtocol(object):
             zbx_answer = self.bulk_send(container)
         return zbx_answer
 
+    def _payload_head(self):
+        return '{"request": %s, "clock": %d, "data": [' % (
+            simplejson.dumps(self.request), int(time.time()))
+
+    def _spooled_data(self):
+        """ Stream spooled items from disk instead of building the whole
+            JSON payload in memory """
+        (spool, spool_len) = self.data_container.flush_spool()
+        head = self._payload_head()
+        tail = ']}'
+
+        def chunks():
+            yield head
+            spool.seek(0)
+            chunk = spool.read(ZBX_SPOOL_CHUNK)
+            while chunk:
+                yield chunk
+                chunk = spool.read(ZBX_SPOOL_CHUNK)
+            yield tail
+
+        return (chunks(), len(head) + spool_len + len(tail))
+
     def bulk_send(self, container):
         self.data_container = container
-        data = simplejson.dumps({ "data": self.data_container.get_items_list(),
-                                  "request": self.request,
-                                  "clock": int(time.time()) })
-        zbx_answer = self.send_to_zabbix(data)
+        if getattr(self.data_container, 'spool', None) is not None:
+            zbx_answer = self.send_to_zabbix(*self._spooled_data())
+        else:
+            data = self._payload_head() + ',\n'.join(
+                simplejson.dumps(item)
+                for item in self.data_container.iter_items()) + ']}'
+            zbx_answer = self.send_to_zabbix(data)
         if self.verbosity:
             print zbx_answer.get('info')
         return zbx_answer
 
     def single_send(self, container):
         self.data_container = container
-        for item in self.data_container.get_items_list():
+        for item in self.data_container.iter_items():
             data = simplejson.dumps({ "data": [ item ],
                                       "request": self.request,
                                       "clock": int(time.time()) })
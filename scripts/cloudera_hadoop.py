@@ -16,16 +16,10 @@ from subprocess import call
 from time import sleep, time
 from urllib2 import quote
 
-import cm_api.endpoints.clusters
-import cm_api.endpoints.hosts
-import cm_api.endpoints.services
-import cm_api.endpoints.roles
-import cm_api.endpoints.cms
-from cm_api.api_client import get_root_resource, ApiException
-from cm_api.endpoints.roles import get_all_roles
-
 import protobix
 
+cm_api = protobix.LazyModule('cm_api.api_client')
+
 class ClouderaHadoop(protobix.SampleProbe):
 
     __version__="0.0.9"
@@ -78,7 +72,7 @@ class ClouderaHadoop(protobix.SampleProbe):
             self.options.host = socket.getfqdn()
         self.hostname = self.options.host
         (username, password) = open(self.options.config, 'r').readline().rstrip('\n').split(':')
-        self.cdh_api = get_root_resource(
+        self.cdh_api = cm_api.api_client.get_root_resource(
             self.options.host,
             self.options.port,
             username,
@@ -277,6 +271,7 @@ class ClouderaHadoop(protobix.SampleProbe):
         return data
 
 if __name__ == '__main__':
+    protobix.mark_started()
     ret = ClouderaHadoop().run()
     print((ret))
     sys.exit(ret)
@@ -8,7 +8,8 @@ import sys
 import simplejson
 import protobix
 #from elasticsearch import Elasticsearch
-import requests
+
+requests = protobix.LazyModule('requests')
 
 class ElasticsearchServer(protobix.SampleProbe):
     __version__="0.0.9"
@@ -411,6 +412,7 @@ class ElasticsearchServer(protobix.SampleProbe):
         return data
 
 if __name__ == '__main__':
+    protobix.mark_started()
     ret = ElasticsearchServer().run()
     print((ret))
     sys.exit(ret)
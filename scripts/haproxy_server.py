@@ -4,22 +4,118 @@
 # -*- coding: utf-8 -*-
 
 import socket
+import copy
 import csv
+import glob
 import optparse
 import protobix
 import select
 import sys
 
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 from time import time
 from traceback import format_exc
 
 class TimeoutException(Exception):
     pass
 
+class StatsSession(object):
+    """ HAProxy stats socket client running several commands over a single
+    connection, using the interactive (prompt) mode of the CLI.
+    Each reply ends with the prompt, and each call has its own deadline.
+    """
+
+    PROMPT = '\n> '
+    CHUNK_SIZE = 65536
+
+    def __init__(self, socket_name, timeout=3):
+        self.socket_name = socket_name
+        self.timeout = timeout
+        self.client = None
+        self.chunk = bytearray(self.CHUNK_SIZE)
+
+    def _connect(self, deadline):
+        self.client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.client.settimeout(self.timeout)
+        self.client.connect(self.socket_name)
+        self.client.sendall('prompt\n')
+        self._read_reply(deadline)
+
+    def _read_reply(self, deadline):
+        buffer = bytearray()
+        view = memoryview(self.chunk)
+        while not buffer.endswith(self.PROMPT):
+            remaining = deadline - time()
+            if remaining <= 0:
+                raise TimeoutException('HAProxy stats socket timed out')
+            self.client.settimeout(remaining)
+            try:
+                size = self.client.recv_into(self.chunk)
+            except socket.timeout:
+                raise TimeoutException('HAProxy stats socket timed out')
+            if not size:
+                raise socket.error('HAProxy closed stats socket')
+            buffer.extend(view[:size])
+        del buffer[-len(self.PROMPT):]
+        return str(buffer)
+
+    def execute(self, command, timeout=None):
+        deadline = time() + (timeout or self.timeout)
+        try:
+            if self.client is None:
+                self._connect(deadline)
+            self.client.sendall(command + '\n')
+            return self._read_reply(deadline)
+        except (socket.error, TimeoutException):
+            ''' Reply boundaries are lost: never reuse this connection '''
+            self.close()
+            raise
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
 class HAProxyServer(protobix.SampleProbe):
 
     __version__ = '0.0.9'
 
+    CACHE_TTLS = { 'info': 30, 'stat': 30, 'servers': 30, 'schema': 86400 }
+
+    ''' Backend and server level columns '''
+    SERVER_COLUMNS = ('qcur', 'qmax', 'scur', 'smax', 'slim', 'stot',
+                      'econ', 'eresp', 'wretr', 'wredis', 'status', 'weight',
+                      'act', 'bck', 'chkfail', 'chkdown', 'downtime',
+                      'check_status', 'check_duration',
+                      'qtime', 'ctime', 'rtime', 'ttime')
+
+    ''' Merge of multi-process stats: gauges shared by all processes are
+        de-duplicated, *max and average time columns take the maximum,
+        any other numeric column is summed '''
+    SHARED_COLUMNS = set(['check_status', 'check_code', 'weight',
+                          'act', 'bck', 'slim', 'qlimit', 'rate_lim',
+                          'downtime', 'lastchg', 'pid', 'iid', 'sid', 'type'])
+    MAX_COLUMNS = set(['check_duration', 'qtime', 'ctime', 'rtime', 'ttime',
+                       'lastsess', 'last_chk', 'last_agt'])
+    ''' status is merged by severity: a process seeing a proxy or server
+        down wins over the others. Prefixes, worst first, anything else
+        (UP, OPEN, no check) ranks last '''
+    STATUS_SEVERITY = ('MAINT', 'DOWN', 'STOP', 'NOLB', 'DRAIN', 'FULL', 'UP ')
+
+    ''' Typed output (HAProxy >= 1.7): natures and formats of parsed fields.
+        Counter, Gauge, Limit, Max, avg, Duration and Rate natures '''
+    TYPED_NATURES = set(['C', 'G', 'L', 'M', 'a', 'D', 'R'])
+    TYPED_FORMATS = set(['s32', 's64', 'u32', 'u64', 'flt'])
+    TYPED_OBJECTS = set(['F', 'B', 'S'])
+    TYPED_STRINGS = set(['status', 'check_status'])
+    TYPED_COLUMNS_VERSION = '1.5'
+
+    ''' show stat <iid> <type> <sid> type bitfield '''
+    STAT_TYPE_FRONTEND = 1
+    STAT_TYPE_BACKEND = 2
+    STAT_TYPE_SERVER = 4
+
     def _get_options(self, v):
         options = {'1.3': (
             {'hap_proxy_name': False},
@@ -180,60 +276,302 @@ class HAProxyServer(protobix.SampleProbe):
 
         return options[v[:3]]
 
-    def _cmd_exec(self, command, timeout=200):
-        """ Executes a HAProxy command by sending a message to a HAProxy's local
-    UNIX socket and waiting up to 'timeout' milliseconds for the response.
+    def _cmd_exec(self, command):
+        """ Executes a HAProxy command over the stats session, which is
+    opened on first use and shared by all commands of a run.
     """
-
-        buffer = ''
-        socket.setdefaulttimeout(3)
-        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        client.connect(self.socket_name)
-        client.send(command + '\n')
-        output = client.recv(8192)
-        while output:
-            buffer += output.decode('ASCII')
-            output = client.recv(8192)
-
-        client.close()
-        return buffer
+        return self.session.execute(command)
 
     def _get_version(self):
-        buffer = self._cmd_exec(command='show info')
+        buffer = self.cache.fetch('info', self._cmd_exec, 'show info')
         buffer = buffer.strip()
         lines = buffer.split('\n')
         self.info = dict(row.strip().split(':', 1) for row in lines)
         return self.info['Version'].strip()
 
-    def _get_data(self):
+    def _get_projection(self, key, header, columns):
+        """ Resolve once per key (version) the header indices of wanted
+    columns. Returns a list of (index, column name) tuples.
+    """
+        if key not in self.projections:
+            self.projections[key] = [ (header.index(name), name)
+                                      for name in columns if name in header ]
+        return self.projections[key]
+
+    def _parse_stat(self, buffer, key, columns):
+        """ Stream CSV rows of a show stat output, keeping only wanted
+    columns. Yields (pxname, svname, iid, stats) tuples.
+    """
+        csv_stat = csv.reader(StringIO(buffer.lstrip('# ')))
+        header = csv_stat.next()
+        projection = self._get_projection(key, header, columns)
+        pxname_index = header.index('pxname')
+        svname_index = header.index('svname')
+        iid_index = header.index('iid')
+        for row in csv_stat:
+            if not row:
+                continue
+            stats = dict([ (name, row[index]) for (index, name) in projection ])
+            yield (row[pxname_index], row[svname_index], row[iid_index], stats)
+
+    def _get_typed_schema(self, version, buffer):
+        """ Natures and formats of typed fields, by field name. Built from
+    the first typed output of a version, then cached.
+    """
+        schema = self.cache.get('schema', version)
+        if schema is None:
+            schema = {}
+            for line in StringIO(buffer):
+                fields = line.split(':', 3)
+                if len(fields) < 4:
+                    continue
+                name = fields[0].split('.')[4]
+                if name not in schema:
+                    schema[name] = (fields[1][1:2], fields[2])
+            self.cache.set('schema', schema, version)
+        ''' Natures and formats drive multi-process merge '''
+        for name in schema:
+            (self.natures[name], self.formats[name]) = schema[name]
+        return schema
+
+    def _get_typed_projection(self, version, schema, columns):
+        key = ('typed', version, columns)
+        if key not in self.projections:
+            relevant = set([ name for name in schema
+                             if (schema[name][0] in self.TYPED_NATURES and
+                                 schema[name][1] in self.TYPED_FORMATS) or
+                                name in self.TYPED_STRINGS ])
+            if columns is not None:
+                relevant &= set(columns)
+            self.projections[key] = relevant
+        return self.projections[key]
+
+    def _parse_typed(self, buffer, version, columns=None):
+        """ Stream a 'show stat typed' output, one line per field, keeping
+    only relevant numeric fields (restricted to columns, if any).
+    Yields (pxname, svname, iid, stats) tuples, like _parse_stat.
+    """
+        schema = self._get_typed_schema(version, buffer)
+        relevant = self._get_typed_projection(version, schema, columns)
+        current = None
+        for line in StringIO(buffer):
+            fields = line.rstrip('\n').split(':', 3)
+            if len(fields) < 4:
+                continue
+            (objtype, iid, sid, position, name, process) = \
+                fields[0].split('.', 5)
+            if objtype not in self.TYPED_OBJECTS:
+                continue
+            if (objtype, iid, sid) != current:
+                if current is not None:
+                    yield (pxname, svname, current[1], stats)
+                current = (objtype, iid, sid)
+                (pxname, svname, stats) = (None, None, {})
+            if name == 'pxname':
+                pxname = fields[3]
+            elif name == 'svname':
+                svname = fields[3]
+            elif name in relevant:
+                stats[name] = fields[3]
+        if current is not None:
+            yield (pxname, svname, current[1], stats)
 
-        def get_output_key(index):
-            return index.keys()[0]
+    def _read_stat(self, source, command, key, columns=None):
+        """ Run a show stat command, in CSV or typed mode, and stream its
+    rows. columns=None keeps every relevant typed field.
+    """
+        if self.options.typed:
+            buffer = self.cache.fetch(source, self._cmd_exec,
+                                      command + ' typed')
+            return self._parse_typed(buffer, self._get_version(), columns)
+        buffer = self.cache.fetch(source, self._cmd_exec, command)
+        return self._parse_stat(buffer, key, columns)
 
+    def _get_data(self):
         hap_version = self._get_version()
-        buffer = self._cmd_exec('show stat')
-        buffer = buffer.lstrip('# ')
-        csv_stat = csv.DictReader(buffer.split(',\n'))
+        ''' Rows are streamed, and only wanted columns are kept. Typed
+            fields are named after 1.5 CSV columns: keep the same ones,
+            which are those the template defines items for. '''
+        columns_version = hap_version
+        if self.options.typed:
+            columns_version = self.TYPED_COLUMNS_VERSION
+        columns = tuple([ option.keys()[0] for option
+                          in self._get_options(columns_version)
+                          if option.values()[0] is True ])
         data = {}
-        for row in csv_stat:
-            if row['pxname'] not in data:
-                data[row['pxname']] = {}
-            if row['svname'] in ['FRONTEND']:
-                options_list = self._get_options(hap_version)
-                pool_stats = {}
-                for i in range(0, len(options_list)):
-                    key = get_output_key(options_list[i])
-                    if options_list[i][key] is True:
-                        pool_stats[key] = row[key]
-                data[row['pxname']] = pool_stats
+        for (pxname, svname, iid, stats) in \
+                self._read_stat('stat', 'show stat', hap_version, columns):
+            if svname == 'FRONTEND':
+                data[pxname] = stats
+            elif pxname not in data:
+                data[pxname] = {}
         return data
 
+    def _get_servers_commands(self):
+        """ Without proxy filter, a single command returns all backends and
+    servers. Otherwise, only listed proxies are scraped, by proxy id.
+    """
+        stat_type = self.STAT_TYPE_BACKEND | self.STAT_TYPE_SERVER
+        if not self.proxies:
+            return [ 'show stat -1 %d -1' % stat_type ]
+        ''' Backend rows only, to map proxy names to proxy ids '''
+        command = 'show stat -1 %d -1' % self.STAT_TYPE_BACKEND
+        return [ 'show stat %s %d -1' % (iid, stat_type)
+                 for (pxname, svname, iid, stats)
+                 in self._read_stat('servers', command, 'backends', ())
+                 if pxname in self.proxies ]
+
+    def _get_servers_data(self):
+        """ Returns backends stats indexed by proxy name, and servers stats
+    indexed by (proxy name, server name) """
+        backends = {}
+        servers = {}
+        for command in self._get_servers_commands():
+            for (pxname, svname, iid, stats) in \
+                    self._read_stat('servers', command, 'servers',
+                                    self.SERVER_COLUMNS):
+                if svname == 'BACKEND':
+                    backends[pxname] = stats
+                elif svname != 'FRONTEND':
+                    servers[(pxname, svname)] = stats
+        return (backends, servers)
+
+    def _get_servers_metrics(self, data):
+        (backends, servers) = self._get_merged_servers_data()
+        items = [ ('haproxy.server.backend[{0},{1}]', (pxname,),
+                   backends[pxname]) for pxname in backends ]
+        items.extend([ ('haproxy.server.server[{0},{1},{2}]', name,
+                        servers[name]) for name in servers ])
+        for (zbx_key, name, stats) in items:
+            for metric in stats:
+                value = stats[metric]
+                if value == '':
+                    value = 0
+                elif metric == 'status':
+                    ''' UP, UP 1/3 (going down), DOWN, MAINT, no check... '''
+                    value = int(value.startswith('UP') or value == 'no check')
+                data[zbx_key.format(*(name + (metric,)))] = value
+
+    def _parse_number(self, metric, value):
+        """ Parse a stat value according to its typed format, if known:
+    flt fields are floats, any other numeric field is an integer.
+    """
+        if self.formats.get(metric) == 'flt':
+            return float(value)
+        return int(value)
+
+    def _get_status_severity(self, value):
+        for (rank, prefix) in enumerate(self.STATUS_SEVERITY):
+            if value.startswith(prefix):
+                return rank
+        return len(self.STATUS_SEVERITY)
+
+    def _merge_stats(self, stats_list):
+        merged = {}
+        for stats in stats_list:
+            for (metric, value) in stats.items():
+                if merged.get(metric, '') == '':
+                    merged[metric] = value
+                    continue
+                if metric == 'status' and value != '':
+                    if self._get_status_severity(value) < \
+                            self._get_status_severity(merged[metric]):
+                        merged[metric] = value
+                    continue
+                nature = self.natures.get(metric)
+                if value == '' or metric in self.SHARED_COLUMNS or \
+                        nature == 'L':
+                    continue
+                try:
+                    previous = self._parse_number(metric, merged[metric])
+                    value = self._parse_number(metric, value)
+                    if metric.endswith('max') or metric in self.MAX_COLUMNS or \
+                            nature in ('M', 'a', 'D'):
+                        merged[metric] = max(previous, value)
+                    else:
+                        merged[metric] = previous + value
+                except ValueError:
+                    ''' Not a numeric column, keep first process value '''
+                    pass
+        return merged
+
+    def _merge_proxies(self, results):
+        """ Merge stats dicts of each socket, by proxy (or server) name """
+        if len(results) == 1:
+            return results[0]
+        names = {}
+        for result in results:
+            for name in result:
+                names.setdefault(name, []).append(result[name])
+        return dict([ (name, self._merge_stats(names[name]))
+                      for name in names ])
+
+    def _get_socket_probe(self, socket_name):
+        ''' Return a copy of this probe bound to a single stats socket '''
+        probe = copy.copy(self)
+        probe.socket_name = socket_name
+        probe.session = StatsSession(socket_name, self.options.timeout)
+        probe.cache = protobix.ProbeCache('haproxy_server', self.CACHE_TTLS,
+                                          socket_name)
+        return probe
+
+    def _open_socket_probes(self):
+        """ Build socket probes once per run: pools, backends and servers
+    stats of a socket are all read over the same session.
+    """
+        self.socket_probes = [ self._get_socket_probe(socket_name)
+                               for socket_name in self.socket_names ]
+
+    def _close_socket_probes(self):
+        for probe in self.socket_probes:
+            probe.session.close()
+        self.socket_probes = []
+
+    def _collect_socket(self, args):
+        (probe, method_name) = args
+        return getattr(probe, method_name)()
+
+    def _collect_sockets(self, method_name):
+        """ Call method_name for each HAProxy process socket, concurrently.
+    Any socket failure fails the run: partial sums would be misleading.
+    """
+        args = [ (probe, method_name) for probe in self.socket_probes ]
+        if len(args) == 1:
+            return [ self._collect_socket(args[0]) ]
+        pool = ThreadPool(len(args))
+        try:
+            return pool.map(self._collect_socket, args)
+        finally:
+            pool.close()
+
+    def _get_merged_data(self):
+        return self._merge_proxies(self._collect_sockets('_get_data'))
+
+    def _get_merged_servers_data(self):
+        results = self._collect_sockets('_get_servers_data')
+        return (self._merge_proxies([ backends for (backends, servers)
+                                      in results ]),
+                self._merge_proxies([ servers for (backends, servers)
+                                      in results ]))
+
     def _init_probe(self):
         if self.options.host == 'localhost':
             self.options.host = socket.getfqdn()
         self.hostname = self.options.host
-        self.socket_name = self.options.socket
+        ''' One stats socket per HAProxy process (nbproc) '''
+        self.socket_names = []
+        for pattern in self.options.socket.split(','):
+            self.socket_names.extend(sorted(glob.glob(pattern)) or [pattern])
+        self.projections = {}
+        self.natures = {}
+        self.formats = {}
+        self.socket_probes = []
+        self.proxies = set()
+        if self.options.proxies:
+            self.proxies = set(self.options.proxies.split(','))
         self.discovery_key = 'haproxy_server.pools.discovery'
+        self.backends_discovery_key = 'haproxy_server.backends.discovery'
+        self.servers_discovery_key = 'haproxy_server.servers.discovery'
 
     def _parse_args(self):
         # Parse the script arguments
@@ -248,7 +586,22 @@ class HAProxyServer(protobix.SampleProbe):
                                    help='Haproxy stats port')
         haproxy_options.add_option('-s', '--socket',
                                    default='/run/haproxy.socket',
-                                   help='Haproxy stats port')
+                                   help='Haproxy stats sockets, comma '
+                                        'separated paths or globs')
+        haproxy_options.add_option('--timeout', default=3, type='float',
+                                   help='Haproxy stats socket timeout per '
+                                        'command, in seconds')
+        haproxy_options.add_option('--typed', action='store_true',
+                                   default=False,
+                                   help='Use typed stats output, field '
+                                        'natures drive multi-process merge '
+                                        '(HAProxy >= 1.7)')
+        haproxy_options.add_option('--servers', action='store_true',
+                                   default=False,
+                                   help='Collect backend and server stats')
+        haproxy_options.add_option('--proxies', default=None,
+                                   help='Comma separated backends to collect '
+                                        'server stats from (default: all)')
         haproxy_options.add_option('--username', default='zabbix',
                                    help='Haproxy stats username')
         haproxy_options.add_option('--password', default='zabbix',
@@ -260,16 +613,41 @@ class HAProxyServer(protobix.SampleProbe):
         return (options, args)
 
     def _get_discovery(self):
-        raw_data = self._get_data()
+        self._open_socket_probes()
+        try:
+            return self._get_sockets_discovery()
+        finally:
+            self._close_socket_probes()
+
+    def _get_sockets_discovery(self):
+        raw_data = self._get_merged_data()
         data = {self.discovery_key: []}
         for pxname in raw_data:
             element = {'{#HAPPOOLNAME}': pxname}
             data[self.discovery_key].append(element)
+        if self.options.servers:
+            ''' Keep LLD rows minimal: thousands of servers are expected '''
+            (backends, servers) = self._get_merged_servers_data()
+            data[self.backends_discovery_key] = [ {'{#HAPBACKEND}': pxname}
+                                                  for pxname in backends ]
+            data[self.servers_discovery_key] = [ {'{#HAPBACKEND}': pxname,
+                                                  '{#HAPSERVER}': svname}
+                                                 for (pxname, svname)
+                                                 in servers ]
         return { self.hostname: data }
 
     def _get_metrics(self):
-        raw_data = self._get_data()
+        self._open_socket_probes()
+        try:
+            return self._get_sockets_metrics()
+        finally:
+            self._close_socket_probes()
+
+    def _get_sockets_metrics(self):
+        raw_data = self._get_merged_data()
         data = {}
+        if self.options.servers:
+            self._get_servers_metrics(data)
         for pxname in raw_data:
             for metric in raw_data[pxname]:
                 if raw_data[pxname][metric] == '':
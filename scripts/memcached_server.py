@@ -7,7 +7,8 @@ import optparse
 import socket
 import sys
 import protobix
-import memcache
+
+memcache = protobix.LazyModule('memcache')
 
 class MemcachedServer(protobix.SampleProbe):
 
@@ -54,6 +55,7 @@ class MemcachedServer(protobix.SampleProbe):
         return { self.hostname: data }
 
 if __name__ == '__main__':
+    protobix.mark_started()
     ret = MemcachedServer().run()
     print ret
     sys.exit(ret)
\ No newline at end of file
@@ -6,14 +6,25 @@
 '''
 
 import optparse
+import copy
+import errno
+import heapq
 import json
+import os
 import socket
-import mysql.connector
 import re
+import stat
 import sys
+import tempfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 import protobix
 
+mysql = protobix.LazyModule('mysql.connector')
+yaml = protobix.LazyModule('yaml')
+
 # MariaDB 10.0 slave key's list
 # WARNING
 # Order is important !!!
@@ -72,7 +83,7 @@ replication_keys=[
     'gtid_slave_pos'
 ]
 
-wsrep_status_keys=[
+wsrep_status_keys=set([
     'apply_oooe',
     'apply_oool',
     'apply_window',
@@ -96,9 +107,9 @@ wsrep_status_keys=[
     'replicated',
     'replicated_bytes',
     'thread_count'
-]
+])
 
-status_bl = [
+status_bl = set([
     'binlog_bytes_written',
     'binlog_cache_disk_use',
     'binlog_cache_use',
@@ -203,6 +214,95 @@ status_bl = [
     'slave_received_heartbeats',
     'slave_retried_transactions',
     'slave_running'
+])
+
+MYSQL_QUERIES = {
+    'replication': "SHOW ALL SLAVES STATUS",
+    'status': "SHOW GLOBAL STATUS",
+    'engines': "SHOW ENGINES",
+    'wsrep_ready': "SHOW GLOBAL STATUS LIKE 'wsrep_ready'",
+    'innodb_status': "SHOW /*!50000 ENGINE*/ INNODB STATUS",
+    'buffer_pool_instances':
+        "SHOW GLOBAL VARIABLES LIKE 'innodb_buffer_pool_instances'"
+}
+
+MYSQL_DIGEST_QUERY = (
+    "SELECT schema_name, digest, LEFT(digest_text, %s), count_star,"
+    " sum_timer_wait, sum_rows_examined, sum_rows_sent"
+    " FROM performance_schema.events_statements_summary_by_digest"
+    " WHERE digest IS NOT NULL"
+)
+MYSQL_DIGEST_TEXT_LEN = 128
+MYSQL_DIGEST_FIELDS = ['calls', 'latency', 'rows_examined', 'rows_sent']
+MYSQL_DIGEST_TOP_FIELDS = ['latency', 'rows_examined', 'calls']
+
+MYSQL_SCHEMAS_QUERY = "SELECT schema_name FROM information_schema.SCHEMATA"
+MYSQL_SCHEMAS_BL = ['information_schema', 'performance_schema']
+MYSQL_TABLES_QUERY = (
+    "SELECT table_name, data_length, index_length"
+    " FROM information_schema.TABLES WHERE table_schema = %s"
+)
+
+''' Heartbeat table, pt-heartbeat --utc format. ts is written and read
+    with microseconds, replication lag is computed server side.
+    server_id is a literal: with statement based replication, @@server_id
+    would be evaluated again, to their own id, by replicas. '''
+MYSQL_HEARTBEAT_UPDATE = (
+    "REPLACE INTO {0} (ts, server_id)"
+    " VALUES (DATE_FORMAT(UTC_TIMESTAMP(6), '%Y-%m-%dT%H:%i:%s.%f'), {1:d})"
+)
+MYSQL_SERVER_ID_QUERY = "SELECT @@server_id"
+MYSQL_HEARTBEAT_QUERY = (
+    "SELECT server_id, TIMESTAMPDIFF(MICROSECOND,"
+    " STR_TO_DATE(ts, '%Y-%m-%dT%H:%i:%s.%f'), UTC_TIMESTAMP(6)) FROM {0}"
+)
+''' Lag read on replicas is late by up to the primary write interval '''
+MYSQL_HEARTBEAT_INTERVAL = 1.0
+
+''' Connections kept open between runs with --persistent, indexed by
+    server and credentials. A connection is taken out while in use, so that
+    a hung worker thread never shares it with the next run. '''
+MYSQL_CONNECTIONS = {}
+
+''' Columns order matches MYSQL_PROCESSLIST_DIMENSIONS, then query age '''
+MYSQL_PROCESSLIST_QUERY = (
+    "SELECT user, command, state, SUBSTRING_INDEX(host, ':', 1), time"
+    " FROM information_schema.PROCESSLIST WHERE id <> CONNECTION_ID()"
+)
+MYSQL_PROCESSLIST_DIMENSIONS = ['user', 'command', 'state', 'host']
+MYSQL_PROCESSLIST_IDLE_COMMANDS = set(['Sleep', 'Daemon', 'Binlog Dump',
+                                       'Binlog Dump GTID'])
+''' Upper bounds, in seconds, of running query age histogram buckets '''
+MYSQL_PROCESSLIST_AGE_BUCKETS = [1, 10, 60, 300]
+''' Dimension values unseen for that long, in seconds, are forgotten '''
+MYSQL_PROCESSLIST_VALUES_TTL = 7 * 86400
+
+''' Parent of the default, per-user, state directory '''
+MYSQL_STATE_BASE_DIR = '/var/tmp'
+
+''' Counters exported as per second rates with --rates '''
+MYSQL_RATE_COUNTERS = [
+    'bytes_received',
+    'bytes_sent',
+    'com_delete',
+    'com_insert',
+    'com_select',
+    'com_update',
+    'connections',
+    'innodb_data_reads',
+    'innodb_data_writes',
+    'innodb_rows_deleted',
+    'innodb_rows_inserted',
+    'innodb_rows_read',
+    'innodb_rows_updated',
+    'queries',
+    'questions',
+    'slow_queries'
+]
+
+''' Options which can be overridden per target in --targets file '''
+MYSQL_TARGET_OPTIONS = [
+    'host', 'port', 'socket', 'username', 'password', 'database'
 ]
 
 MYSQL_REPLICATION_MAPPING = { "Connecting": 1, "Yes": 1, "No": 0 }
@@ -213,6 +313,219 @@ MYSQL_INNODB_MAPPING = {
     'OFF': 1
 }
 
+''' SHOW ENGINE INNODB STATUS parsing table
+    Section title => (result key, patterns)
+    Each pattern is (marker, compiled regex, fields, previous line prefix):
+    the regex is only tried on lines containing marker and, if set, right
+    after a line starting with previous line prefix.
+    Fields prefixed with '+' are summed over all matching lines. '''
+INNODB_BUFFER_POOL_PATTERNS = [
+    # Total memory allocated 38972620800; in additional pool allocated 0
+    # Total large memory allocated 38972620800
+    ('memory allocated',
+     re.compile(r'Total (?:large )?memory allocated (\d+)'
+                r'(?:; in additional pool allocated (\d+))?'),
+     ('total_mem_alloc', 'additional_pool_alloc'), None),
+    # Adaptive hash index 3369597072 	(602892328 + 2766704744)
+    ('Adaptive hash index', re.compile(r'Adaptive hash index\s+(\d+)'),
+     ('adaptive_hash_memory',), None),
+    # Page hash           3140888 (buffer pool 0 only)
+    ('Page hash', re.compile(r'Page hash\s+(\d+)'),
+     ('page_hash_memory',), None),
+    # Dictionary cache    153440970 	(150724592 + 2716378)
+    ('Dictionary cache', re.compile(r'Dictionary cache\s+(\d+)'),
+     ('dictionary_cache_memory',), None),
+    # File system         1032976 	(812272 + 220704)
+    ('File system', re.compile(r'File system\s+(\d+)'),
+     ('file_system_memory',), None),
+    # Lock system         94209256 	(94203496 + 5760)
+    ('Lock system', re.compile(r'Lock system\s+(\d+)'),
+     ('lock_system_memory',), None),
+    # Recovery system     0 	(0 + 0)
+    ('Recovery system', re.compile(r'Recovery system\s+(\d+)'),
+     ('recovery_system_memory',), None),
+    # Buffer pool size        2324208
+    ('Buffer pool size', re.compile(r'Buffer pool size\s+(\d+)$'),
+     ('pool_size',), None),
+    # Free buffers            12265
+    ('Free buffers', re.compile(r'Free buffers\s+(\d+)$'),
+     ('free_pages',), None),
+    # Database pages          2143077
+    ('Database pages', re.compile(r'Database pages\s+(\d+)$'),
+     ('database_pages',), None),
+    # Old database pages      790857
+    ('Old database pages', re.compile(r'Old database pages\s+(\d+)$'),
+     ('old_pages',), None),
+    # Modified db pages       128001
+    ('Modified db pages', re.compile(r'Modified db pages\s+(\d+)$'),
+     ('modified_pages',), None),
+    # Pending reads 0
+    ('Pending reads', re.compile(r'Pending reads\s+(\d+)$'),
+     ('pending_reads',), None),
+    # Pages made young 168684656, not young 1422812817
+    ('Pages made young',
+     re.compile(r'Pages made young (\d+), not young (\d+)$'),
+     ('pages_made_young', 'pages_not_young'), None),
+    # Pages read 158403177, created 13432370, written 501462122
+    ('Pages read', re.compile(r'Pages read (\d+), created (\d+), written (\d+)$'),
+     ('pages_read', 'pages_created', 'pages_written'), None),
+    # 36.14 reads/s, 1.42 creates/s, 122.14 writes/s
+    ('creates/s',
+     re.compile(r'([\.\d]+) reads/s, ([\.\d]+) creates/s, ([\.\d]+) writes/s$'),
+     ('reads_per_sec', 'creates_per_sec', 'writes_per_sec'), None),
+    # Buffer pool hit rate 999 / 1000, young-making rate 1 / 1000 not 7 / 1000
+    ('Buffer pool hit rate', re.compile(r'Buffer pool hit rate (\d+) / (\d+)'),
+     ('hit_rate', 'hit_rate_base'), None),
+]
+
+INNODB_STATUS_SECTIONS = {
+    'BACKGROUND THREAD': (None, ()),
+    'LATEST FOREIGN KEY ERROR': (None, ()),
+    'LATEST DETECTED DEADLOCK': (None, ()),
+    'SEMAPHORES': ('semaphores', [
+        # Mutex spin waits 79626940, rounds 157459864, OS waits 698719
+        ('Mutex spin waits',
+         re.compile(r'Mutex spin waits (\d+), rounds (\d+), OS waits (\d+)$'),
+         ('+spin_waits', '+spin_rounds', '+os_waits'), None),
+        # Pre 5.5.17:
+        # RW-shared spins 3859028, OS waits 2100750; RW-excl spins 4641946, OS waits 1530310
+        ('RW-shared spins',
+         re.compile(r'RW-shared spins (\d+), OS waits (\d+); '
+                    r'RW-excl spins (\d+), OS waits (\d+)$'),
+         ('+spin_waits', '+os_waits', '+spin_waits', '+os_waits'), None),
+        # Post 5.5.17:
+        # RW-shared spins 604733, rounds 8107431, OS waits 241268
+        # RW-excl spins 604733, rounds 8107431, OS waits 241268
+        # RW-sx spins 604733, rounds 8107431, OS waits 241268
+        (' spins ',
+         re.compile(r'RW-(?:shared|excl|sx) spins (\d+), rounds (\d+), '
+                    r'OS waits (\d+)$'),
+         ('+spin_waits', '+spin_rounds', '+os_waits'), None),
+    ]),
+    'TRANSACTIONS': ('transactions', [
+        # Trx id counter 18594322142
+        ('Trx id counter', re.compile(r'Trx id counter (\d+)$'),
+         ('innodb_transactions',), None),
+        # Purge done for trx's n:o < 18594381626 undo n:o < 0 state: running but idle
+        ('Purge done', re.compile(r"Purge done for trx's n:o < (\d+)"),
+         ('purged_txns',), None),
+        # History list length 2219
+        ('History list length', re.compile(r'History list length (\d+)'),
+         ('history_list',), None),
+    ]),
+    'FILE I/O': ('file_io', [
+        # 156510952 OS file reads, 1423853152 OS file writes, 162593695 OS fsyncs
+        ('OS file reads',
+         re.compile(r'(\d+) OS file reads, (\d+) OS file writes, (\d+) OS fsyncs$'),
+         ('file_reads', 'file_writes', 'file_fsyncs'), None),
+        # Pending normal aio reads: 0 [0, 0, ...] , aio writes: 0 [0, 0, ...] ,
+        ('Pending normal aio reads',
+         re.compile(r'Pending normal aio reads:\s*(\d+).*aio writes:\s*(\d+)'),
+         ('pending_normal_aio_reads', 'pending_normal_aio_writes'), None),
+        # ibuf aio reads: 0, log i/o's: 0, sync i/o's: 0
+        ('ibuf aio reads',
+         re.compile(r"ibuf aio reads:\s*(\d+), log i/o's:\s*(\d+), "
+                    r"sync i/o's:\s*(\d+)"),
+         ('pending_ibuf_aio_reads', 'pending_aio_log_ios',
+          'pending_aio_sync_ios'), None),
+        # Pending flushes (fsync) log: 0; buffer pool: 0
+        ('Pending flushes',
+         re.compile(r'Pending flushes \(fsync\) log: (\d+); buffer pool: (\d+)$'),
+         ('pending_log_flushes', 'pending_buf_pool_flushes'), None),
+        # 32.46 reads/s, 16384 avg bytes/read, 403.61 writes/s, 69.54 fsyncs/s
+        ('avg bytes/read',
+         re.compile(r'([\.\d]+) reads/s, ([\.\d]+) avg bytes/read, '
+                    r'([\.\d]+) writes/s, ([\.\d]+) fsyncs/s$'),
+         ('reads_per_sec', 'avg_bytes_per_read', 'writes_per_sec',
+          'fsyncs_per_sec'), None),
+    ]),
+    'INSERT BUFFER AND ADAPTIVE HASH INDEX': ('insert_buffer', [
+        # Ibuf: size 1, free list len 155, seg size 157, 53030435 merges
+        ('Ibuf: size',
+         re.compile(r'Ibuf: size (\d+), free list len (\d+), '
+                    r'seg size (\d+), (\d+) merges$'),
+         ('ibuf_used_cells', 'ibuf_free_cells', 'ibuf_cell_count',
+          'ibuf_merges'), None),
+        # merged operations:
+        #  insert 104632411, delete mark 32183433, delete 17962334
+        ('insert ',
+         re.compile(r'insert (\d+), delete mark (\d+), delete (\d+)$'),
+         ('ibuf_inserts', 'ibuf_delete_marks', 'ibuf_deletes'),
+         'merged operations'),
+        # discarded operations:
+        #  insert 104632411, delete mark 32183433, delete 17962334
+        ('insert ',
+         re.compile(r'insert (\d+), delete mark (\d+), delete (\d+)$'),
+         ('ibuf_discarded_inserts', 'ibuf_discarded_delete_marks',
+          'ibuf_discarded_deletes'), 'discarded operations'),
+        # 860.41 hash searches/s, 3066.48 non-hash searches/s
+        ('hash searches/s',
+         re.compile(r'([\.\d]+) hash searches/s, ([\.\d]+) non-hash searches/s$'),
+         ('hash_search_per_sec', 'non_hash_search_per_sec'), None),
+    ]),
+    'LOG': ('log', [
+        # Log sequence number 6552935665366
+        ('Log sequence number', re.compile(r'Log sequence number\s+(\d+)$'),
+         ('log_bytes_written',), None),
+        # Log flushed up to   6552935647135
+        ('Log flushed up to', re.compile(r'Log flushed up to\s+(\d+)$'),
+         ('log_bytes_flushed',), None),
+        # Last checkpoint at  6552701367592
+        ('Last checkpoint at', re.compile(r'Last checkpoint at\s+(\d+)$'),
+         ('last_checkpoint',), None),
+        # 0 pending log writes, 0 pending chkp writes
+        ('pending chkp writes',
+         re.compile(r'(\d+) pending log (?:writes|flushes), '
+                    r'(\d+) pending chkp writes$'),
+         ('pending_log_writes', 'pending_chkp_writes'), None),
+        # 907870229 log i/o's done, 208.50 log i/o's/second
+        ("log i/o's done",
+         re.compile(r"(\d+) log i/o's done, ([\.\d]+) log i/o's/second$"),
+         ('log_writes', 'log_writes_per_sec'), None),
+    ]),
+    'BUFFER POOL AND MEMORY': ('buffer_memory', INNODB_BUFFER_POOL_PATTERNS),
+    'INDIVIDUAL BUFFER POOL INFO': (None, INNODB_BUFFER_POOL_PATTERNS),
+    'ROW OPERATIONS': ('row_ops', [
+        # 0 queries inside InnoDB, 0 queries in queue
+        ('queries inside InnoDB',
+         re.compile(r'(\d+) queries inside InnoDB, (\d+) queries in queue$'),
+         ('queries_inside', 'queries_queued'), None),
+        # 0 read views open inside InnoDB
+        ('read views open',
+         re.compile(r'(\d+) read views open inside InnoDB$'),
+         ('read_views',), None),
+        # 0 RW transactions active inside InnoDB
+        ('RW transactions active',
+         re.compile(r'(\d+) RW transactions active inside InnoDB$'),
+         ('rw_active_transactions',), None),
+        # 0 RO transactions active inside InnoDB
+        ('RO transactions active',
+         re.compile(r'(\d+) RO transactions active inside InnoDB$'),
+         ('ro_active_transactions',), None),
+        # 0 out of 1000 descriptors used
+        ('descriptors used',
+         re.compile(r'(\d+) out of (\d+) descriptors used$'),
+         ('fd_used', 'fd_total'), None),
+        # Number of rows inserted 1084763204, updated 665213995, deleted 438410944, read 7659578616
+        ('Number of rows inserted',
+         re.compile(r'Number of rows inserted (\d+), updated (\d+), '
+                    r'deleted (\d+), read (\d+)$'),
+         ('row_inserted', 'row_updated', 'row_deleted', 'row_read'), None),
+        # 268.24 inserts/s, 137.66 updates/s, 195.83 deletes/s, 824.59 reads/s
+        ('inserts/s',
+         re.compile(r'([\.\d]+) inserts/s, ([\.\d]+) updates/s, '
+                    r'([\.\d]+) deletes/s, ([\.\d]+) reads/s$'),
+         ('insert_per_sec', 'update_per_sec', 'delete_per_sec',
+          'read_per_sec'), None),
+    ]),
+}
+
+# --Thread 907205 has waited at handler/ha_innodb.cc line 7156 for 1.00 seconds the semaphore:
+# Leading literals let the regex engine skip quickly to candidate positions
+INNODB_SECTION_REGEX = re.compile(r'\n---+\n([A-Z][A-Z /]+)\n---+(?=\n)')
+INNODB_ACTIVE_TRX_REGEX = re.compile(r'\n---TRANSACTION [^,\n]*, ACTIVE')
+INNODB_SEM_WAIT_REGEX = re.compile(r'has waited at .* for ([\.\d]+) seconds the semaphore')
+
 class MysqlServer(protobix.SampleProbe):
 
     __version__ = '0.0.9'
@@ -321,481 +634,159 @@ class MysqlServer(protobix.SampleProbe):
             self.key_prefix = 'innodb'
             self.status_prefix = 'Innodb_'
 
-        def _parser(self, lines):
-            data = {}
-            header = False # keep simple state of if we are in a header or not
-            headerStr = ""
-            bodyList = []
-            for line in lines:
-                line = line.strip()
-                if line.startswith('END OF INNODB MONITOR OUTPUT'):
-                    return data
-                if re.match(r'^-+$', line):
-                    header = not header
-                    if headerStr:
-                        data[headerStr] = bodyList
-                        bodyList = []
-                else:
-                    if header:
-                        headerStr = line
-                    else:
-                        bodyList.append(line)
-
-            # Shouldn't really get here
-            return data
-
-        def _buffer_memory_parser(self, lines):
-            result = {}
-            for line in lines:
-                ''' Example:
-                    Total memory allocated 38972620800; in additional pool allocated 0
-                    Total memory allocated by read views 1264
-                '''
-                pattern='^Total memory allocated (\d+); in additional pool allocated (\d+)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['total_mem_alloc'] = int(m.group(1))
-                    result['additional_pool_alloc'] = int(m.group(2))
-                ''' Example:
-                    Adaptive hash index 3369597072 	(602892328 + 2766704744)
-                '''
-                pattern='^Adaptive hash index (\d*).*$'
-                m = re.search(pattern, line)
-                if m:
-                    result['adaptive_hash_memory'] = int(m.group(1))
-                ''' Example:
-                    Page hash           3140888 (buffer pool 0 only)
-                '''
-                pattern='^Page hash\s+(\d+).*$'
-                m = re.search(pattern, line)
-                if m:
-                    result['page_hash_memory'] = int(m.group(1))
-                ''' Example:
-                    Dictionary cache    153440970 	(150724592 + 2716378)
-                '''
-                pattern='^Dictionary cache\s+(\d+)\s+\(\d+ \+ \d+\)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['dictionary_cache_memory'] = int(m.group(1))
-                ''' Example:
-                    File system         1032976 	(812272 + 220704)
-                '''
-                pattern='^File system\s+(\d+) 	\(\d+ \+ \d+\)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['file_system_memory'] = int(m.group(1))
-                ''' Example:
-                    Lock system         94209256 	(94203496 + 5760)
-                '''
-                pattern='^Lock system\s+(\d+) 	\(\d+ \+ \d+\)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['lock_system_memory'] = int(m.group(1))
-                ''' Example:
-                    Recovery system     0 	(0 + 0)
-                '''
-                pattern='^Recovery system\s+(\d+) 	\(\d+ \+ \d+\)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['recovery_system_memory'] = int(m.group(1))
-                ''' Example:
-                    Dictionary memory allocated 2716378
-                '''
-                ''' Example:
-                    Buffer pool size        2324208
-                '''
-                pattern='^Buffer pool size\s+(\d+)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['pool_size'] = int(m.group(1))
-                ''' Example:
-                    Buffer pool size, bytes 38079823872
-                '''
-                ''' Example:
-                    Free buffers            12265
-                '''
-                pattern='^Free buffers\s+(\d+)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['free_pages'] = int(m.group(1))
-                ''' Example:
-                    Database pages          2143077
-                '''
-                pattern='^Database pages\s+(\d+)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['database_pages'] = int(m.group(1))
-                ''' Example:
-                    Old database pages      790857
-                '''
-                ''' Example:
-                    Modified db pages       128001
-                '''
-                pattern='^Modified db pages\s+(\d+)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['modified_pages'] = int(m.group(1))
-                ''' Example:
-                    Pending reads 0
-                '''
-                ''' Example:
-                    Pending writes: LRU 0, flush list 0, single page 0
-                '''
-                ''' Example:
-                    Pages made young 168684656, not young 1422812817
-                '''
-                ''' Example:
-                    39.39 youngs/s, 201.91 non-youngs/s
-                '''
-                ''' Example:
-                    Pages read 158403177, created 13432370, written 501462122
-                '''
-                pattern='^Pages read (\d+), created (\d+), written (\d+)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['pages_read'] = int(m.group(1))
-                    result['pages_created'] = int(m.group(2))
-                    result['pages_written'] = int(m.group(3))
-                ''' Example:
-                    36.14 reads/s, 1.42 creates/s, 122.14 writes/s
-                '''
-                ''' Example:
-                    Buffer pool hit rate 999 / 1000, young-making rate 1 / 1000 not 7 / 1000
-                '''
-                ''' Example:
-                    Pages read ahead 0.00/s, evicted without access 0.00/s, Random read ahead 0.00/s
-                '''
-                ''' Example:
-                    LRU len: 2143077, unzip_LRU len: 0
-                '''
-                ''' Example:
-                    I/O sum[72384]:cur[672], unzip sum[0]:cur[0]
-                '''
-
-            return result
-
-        def _log_parser(self,lines):
-            result = {}
-            for line in lines:
-                ''' Example:
-                    Log sequence number 6552935665366
-                '''
-                pattern='^Log sequence number (\d+)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['log_bytes_written'] = int(m.group(1))
-                ''' Example:
-                    Log flushed up to   6552935647135
-                '''
-                pattern='^Log flushed up to   (\d+)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['log_bytes_flushed'] = int(m.group(1))
-                ''' Example:
-                    Last checkpoint at  6552701367592
-                '''
-                pattern='^Last checkpoint at  (\d+)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['last_checkpoint'] = int(m.group(1))
-                ''' Example:
-                    Max checkpoint age    3056933193
-                '''
-                pattern='^(\d+) pending log writes, (\d+) pending chkp writes$'
-                m = re.search(pattern, line)
-                if m:
-                    result['pending_log_writes'] = int(m.group(1))
-                    result['pending_chkp_writes'] = int(m.group(2))
-                ''' Example:
-                    907870229 log i/o's done, 208.50 log i/o's/second
-                '''
-                pattern='^(\d+) log i\/o\'s done, ([\.\d]+) log i\/o\'s\/second$'
-                m = re.search(pattern, line)
-                if m:
-                    result['log_writes'] = int(m.group(1))
-                    result['log_writes_per_sec'] = m.group(2)
-
-            result['unflushed_log'] = result['log_bytes_written'] - result['log_bytes_flushed']
-            result['uncheckpointed_bytes'] = result['log_bytes_written'] - result['last_checkpoint']
-            return result
-
-        def _insert_buffer_parser(self,lines):
-            result = {}
-            prev_line = ''
-            for line in lines:
-                ''' Example:
-                    156510952 OS file reads, 1423853152 OS file writes, 162593695 OS fsyncs
-                '''
-                pattern = '^(\d+) OS file reads, (\d+) OS file writes, (\d+) OS fsyncs$'
-                m = re.search(pattern, line)
-                if m:
-                    result['file_reads'] = int(m.group(1))
-                    result['file_writes'] = int(m.group(2))
-                    result['file_fsyncs'] = int(m.group(3))
-                ''' Example:
-                    Ibuf: size 1, free list len 155, seg size 157, 53030435 merges
-                '''
-                pattern = '^Ibuf: size (\d+), free list len (\d+), seg size (\d+), (\d+) merges$'
-                m = re.search(pattern, line)
-                if m:
-                    result['ibuf_used_cells'] = int(m.group(1))
-                    result['ibuf_free_cells'] = int(m.group(2))
-                    result['ibuf_cell_count'] = int(m.group(3))
-                    result['ibuf_merges'] = int(m.group(4))
-                ''' Example:
-                    merged operations:
-                    insert 104632411, delete mark 32183433, delete 17962334
-                '''
-                pattern = '^insert (\d+), delete mark (\d+), delete (\d+)$'
-                m = re.search(pattern, line)
-                if m and prev_line.startswith('merged operations') :
-                    result['ibuf_inserts'] = int(m.group(1))
-                    result['ibuf_merged'] = int(m.group(1)) + int(m.group(2)) + int(m.group(3))
-                ''' Example:
-                    discarded operations:
-                    insert 104632411, delete mark 32183433, delete 17962334
-                '''
-                pattern = '^insert (\d+), delete mark (\d+), delete (\d+)$'
-                m = re.search(pattern, line)
-                if m and prev_line.startswith('discarded operations') :
-                    result['ibuf_discarded_inserts'] = int(m.group(1))
-                    result['ibuf_discarded'] = int(m.group(1)) + int(m.group(2)) + int(m.group(2))
-                ''' Example:
-                    860.41 hash searches/s, 3066.48 non-hash searches/s
-                '''
-                pattern = '^([\.\d]+) hash searches\/s, ([\.\d]+) non-hash searches\/s$'
-                m = re.search(pattern, line)
-                if m:
-                    result['hash_search_per_sec'] = m.group(1)
-                    result['non_hash_search_per_sec'] = m.group(2)
-
-                prev_line=line
-            return result
-
-        def _file_io_parser(self,lines):
-            result = {}
-            for line in lines:
-                ''' Example:
-                    156510952 OS file reads, 1423853152 OS file writes, 162593695 OS fsyncs
-                '''
-                pattern = '^(\d+) OS file reads, (\d+) OS file writes, (\d+) OS fsyncs$'
-                m = re.search(pattern, line)
-                if m:
-                    result['file_reads'] = int(m.group(1))
-                    result['file_writes'] = int(m.group(2))
-                    result['file_fsyncs'] = int(m.group(3))
-                ''' Example:
-                    Pending normal aio reads: 0 [0, 0, ...] , aio writes: 0 [0, 0, ...] ,
-                '''
-                pattern = '^Pending normal aio reads: (\d+) .*, aio writes: (\d+)'
-                m = re.search(pattern, line)
-                if m:
-                    result['pending_normal_aio_reads'] = int(m.group(1))
-                    result['pending_normal_aio_writes'] = int(m.group(2))
-                ''' Example:
-                     ibuf aio reads: 0, log i/o's: 0, sync i/o's: 0
-                '''
-                pattern = '^.*ibuf aio reads: (\d+), log i/o\'s: (\d+), sync i/o\'s: (\d+)'
-                m = re.search(pattern, line)
-                if m:
-                    result['pending_ibuf_aio_reads'] = int(m.group(1))
-                    result['pending_aio_log_ios'] = int(m.group(2))
-                    result['pending_aio_sync_ios'] = int(m.group(3))
-                ''' Example:
-                    Pending flushes (fsync) log: 0; buffer pool: 0
-                '''
-                pattern = '^Pending flushes \(fsync\) log: (\d+); buffer pool: (\d+)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['pending_log_flushes'] = int(m.group(1))
-                    result['pending_buf_pool_flushes'] = int(m.group(2))
-                ''' Example:
-                    32.46 reads/s, 16384 avg bytes/read, 403.61 writes/s, 69.54 fsyncs/s
-                '''
-                pattern = '^([\.\d]+) reads\/s, ([\.\d]+) avg bytes\/read, ([\.\d]+) writes\/s, ([\.\d]+) fsyncs\/s$'
-                m = re.search(pattern, line)
-                if m:
-                    result['reads_per_sec'] = m.group(1)
-                    result['avg_bytes_per_read'] = m.group(2)
-                    result['writes_per_sec'] = m.group(3)
-                    result['fsyncs_per_sec'] = m.group(4)
-
-            return result
-
-        def _row_ops_parser(self,lines):
-            result = {}
-            for line in lines:
-                ''' Examples:
-                    0 queries inside InnoDB, 0 queries in queue
-                '''
-                pattern = '^(\d+) queries inside InnoDB, (\d+) queries in queue$'
-                m = re.search(pattern, line)
-                if m:
-                    result['queries_inside'] = int(m.group(1))
-                    result['queries_queued'] = int(m.group(2))
-                ''' Examples:
-                    0 read views open inside InnoDB
-                '''
-                pattern = '^Trx id counter (\d+)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['read_views'] = int(m.group(1))
-                ''' Examples:
-                    0 RW transactions active inside InnoDB
-                '''
-                pattern = '^(\d+) RW transactions active inside InnoDB$'
-                m = re.search(pattern, line)
-                if m:
-                    result['rw_active_transactions'] = int(m.group(1))
-                ''' Examples:
-                    0 RO transactions active inside InnoDB
-                '''
-                pattern = '^(\d+) RO transactions active inside InnoDB$'
-                m = re.search(pattern, line)
-                if m:
-                    result['ro_active_transactions'] = int(m.group(1))
-                ''' Examples:
-                    0 out of 1000 descriptors used
-                '''
-                pattern = '^(\d+) out of (\d+) descriptors used$'
-                m = re.search(pattern, line)
-                if m:
-                    result['fd_used_percent'] = int(m.group(1))*100/int(m.group(2))
-                ''' Examples:
-                    Number of rows inserted 1084763204, updated 665213995, deleted 438410944, read 7659578616
-                '''
-                pattern = '^Number of rows inserted (\d+), updated (\d+), deleted (\d+), read (\d+)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['row_inserted'] = int(m.group(1))
-                    result['row_updated'] = int(m.group(2))
-                    result['row_deleted'] = int(m.group(3))
-                    result['row_read'] = int(m.group(4))
-                ''' Examples:
-                    268.24 inserts/s, 137.66 updates/s, 195.83 deletes/s, 824.59 reads/s
-                '''
-                pattern = '^([\.\d]+) inserts\/s, ([\.\d]+) updates\/s, ([\.\d]+) deletes\/s, ([\.\d]+) reads\/s$'
-                m = re.search(pattern, line)
-                if m:
-                    result['insert_per_sec'] = m.group(1)
-                    result['update_per_sec'] = m.group(2)
-                    result['delete_per_sec'] = m.group(3)
-                    result['read_per_sec'] = m.group(4)
-
-            return result
-
-        def _transactions_parser(self,lines):
-            result = {
-                'current_transactions': 0,
-                'active_transactions': 0
-            }
-            for line in lines:
-                ''' Example:
-                    Trx id counter 18594322142
-                '''
-                pattern = '^Trx id counter (\d+)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['innodb_transactions'] = int(m.group(1))
-                ''' Example:
-                    Purge done for trx's n:o < 18594381626 undo n:o < 0 state: running but idle
-                '''
-                pattern = '^Purge done for trx\'s n:o < (\d+)'
-                m = re.search(pattern, line)
-                if m:
-                    result['purged_txns'] = int(m.group(1))
-                ''' Example:
-                    History list length 2219
-                '''
-                pattern = '^History list length (\d+)'
-                m = re.search(pattern, line)
-                if m:
-                    result['history_list'] = int(m.group(1))
-                ''' Example:
-                    ---TRANSACTION 16559480579, not started
-                    ---TRANSACTION 18594537673, ACTIVE 0 sec committing
-                '''
-                pattern = '^---TRANSACTION (\d+), (\w+)'
-                m = re.search(pattern, line)
-                if m:
-                    result['current_transactions'] += 1
-                    if m.group(1).startswith('ACTIVE'):
-                      result['active_transactions'] += 1
-
-            result['unpurged_txns'] = result['innodb_transactions'] - result['purged_txns']
-            return result
-
-        def _semaphores_parser(self,lines):
+        def _parse(self, text):
+            ''' Parse SHOW ENGINE INNODB STATUS output.
+                Section headers are located with a single regex scan. Each
+                line is then only matched against the patterns of its own
+                section, and only when the pattern marker is found in it.
+                The transaction list, which can be huge, is only counted. '''
             result = {
-                'spin_waits': 0,
-                'spin_rounds' : 0,
-                'os_waits': 0
+                'semaphores': {
+                    'spin_waits': 0,
+                    'spin_rounds': 0,
+                    'os_waits': 0,
+                    'innodb_sem_waits': 0,
+                    'innodb_sem_wait_time_ms': 0
+                },
+                'transactions': {
+                    'current_transactions': 0,
+                    'active_transactions': 0
+                }
             }
-            for line in lines:
-                ''' Example:
-                    Mutex spin waits 79626940, rounds 157459864, OS waits 698719
-                '''
-                pattern = '^Mutex spin waits (\d+), rounds (\d+), OS waits (\d+)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['spin_waits']+=int(m.group(1))
-                    result['spin_rounds']+=int(m.group(2))
-                    result['os_waits']+=int(m.group(3))
-
-                ''' Example: Pre 5.5.17 SHOW ENGINE INNODB STATUS syntax
-                    RW-shared spins 3859028, OS waits 2100750; RW-excl spins 4641946, OS waits 1530310
-                '''
-                pattern = '^RW-shared spins (\d+), rounds (\d+), OS waits (\d+); RW-excl spins (\d+), OS waits (\d+)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['spin_waits']+=int(m.group(1))
-                    result['spin_rounds']+=int(m.group(2))
-                    result['os_waits']+=int(m.group(3))
-
-                ''' Example: Post 5.5.17 SHOW ENGINE INNODB STATUS syntax
-                    RW-shared spins 604733, rounds 8107431, OS waits 241268
-                '''
-                pattern = '^RW-shared spins (\d+), rounds (\d+), OS waits (\d+)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['spin_waits']+=int(m.group(1))
-                    result['spin_rounds']+=int(m.group(2))
-                    result['os_waits']+=int(m.group(3))
-
-                ''' Example: Post 5.5.17 SHOW ENGINE INNODB STATUS syntax
-                    RW-excl spins 604733, rounds 8107431, OS waits 241268
-                '''
-                pattern = 'RW-excl spins (\d+), OS waits (\d+)$'
-                m = re.search(pattern, line)
-                if m:
-                    result['spin_waits']+=int(m.group(1))
-                    result['os_waits']+=int(m.group(2))
-
-                ''' Example:
-                    --Thread 907205 has waited at handler/ha_innodb.cc line 7156 for 1.00 seconds the semaphore:
-                '''
-                pattern = '^--Thread \d+ has waited at handler/ha_innodb.cc line \d+ for ([\.\d+]) seconds the semaphore'
-                m = re.search(pattern, line)
-                if m:
-                    result['innodb_sem_waits']+=1
-                    result['innodb_sem_wait_time_ms']+=int(m.group(1) * 1000)
-
+            ''' Do not scan the transaction list for section headers '''
+            trx_start = text.find('LIST OF TRANSACTIONS FOR EACH SESSION:')
+            if trx_start < 0:
+                headers = list(INNODB_SECTION_REGEX.finditer(text))
+            else:
+                trx_end = text.find('\nFILE I/O\n', trx_start)
+                if trx_end < 0:
+                    trx_end = trx_start
+                else:
+                    ''' Rewind to the dash line preceding FILE I/O title '''
+                    trx_end = text.rfind('\n', trx_start, trx_end)
+                headers = list(INNODB_SECTION_REGEX.finditer(text, 0, trx_start))
+                headers.extend(INNODB_SECTION_REGEX.finditer(text, trx_end))
+            for index in range(len(headers)):
+                title = headers[index].group(1)
+                if title not in INNODB_STATUS_SECTIONS:
+                    continue
+                (section, patterns) = INNODB_STATUS_SECTIONS[title]
+                if not patterns:
+                    continue
+                start = headers[index].end()
+                end = len(text)
+                if index + 1 < len(headers):
+                    end = headers[index + 1].start()
+                body = text[start:end]
+                if section == 'transactions':
+                    body = self._count_transactions(body, result[section])
+                target = None
+                if section is not None:
+                    target = result.setdefault(section, {})
+                prev_line = ''
+                for line in body.splitlines():
+                    line = line.strip()
+                    if line.startswith('--'):
+                        if line.startswith('---BUFFER POOL '):
+                            ''' Per instance buffer pool statistics '''
+                            target = result.setdefault(
+                                'buffer_pool_%s' % line.split()[-1], {})
+                        elif line.startswith('--Thread '):
+                            self._count_semaphore_wait(line, result['semaphores'])
+                    elif target is not None:
+                        self._match_patterns(line, prev_line, patterns, target)
+                    prev_line = line
+            self._add_derived(result)
             return result
 
-        def _get_status(self):
-            result={}
-            cursor = self.server.cnx.cursor()
-            query="SHOW /*!50000 ENGINE*/ INNODB STATUS"
-            cursor.execute(query)
-            for (status_item) in cursor:
-                data = self._parser(status_item[2].split('\n'))
-            result['semaphores'] = self._semaphores_parser(data['SEMAPHORES'])
-            result['transactions'] = self._transactions_parser(data['TRANSACTIONS'])
-            result['file_io'] = self._file_io_parser(data['FILE I/O'])
-            result['insert_buffer'] = self._insert_buffer_parser(data['INSERT BUFFER AND ADAPTIVE HASH INDEX'])
-            result['log'] = self._log_parser(data['LOG'])
-            result['row_ops'] = self._row_ops_parser(data['ROW OPERATIONS'])
-            result['buffer_memory'] = self._buffer_memory_parser(data['BUFFER POOL AND MEMORY'])
+        def _count_transactions(self, body, transactions):
+            ''' Count transactions of the per session list with C level
+                scans, and return the section body before that list '''
+            position = body.find('LIST OF TRANSACTIONS FOR EACH SESSION:')
+            if position < 0:
+                return body
+            trx_list = body[position:]
+            transactions['current_transactions'] = \
+                trx_list.count('\n---TRANSACTION ')
+            transactions['active_transactions'] = \
+                len(INNODB_ACTIVE_TRX_REGEX.findall(trx_list))
+            return body[:position]
+
+        def _count_semaphore_wait(self, line, semaphores):
+            m = INNODB_SEM_WAIT_REGEX.search(line)
+            if m:
+                semaphores['innodb_sem_waits'] += 1
+                semaphores['innodb_sem_wait_time_ms'] += \
+                    int(float(m.group(1)) * 1000)
+
+        def _match_patterns(self, line, prev_line, patterns, target):
+            for (marker, regex, fields, after) in patterns:
+                if marker not in line:
+                    continue
+                if after is not None and not prev_line.startswith(after):
+                    continue
+                m = regex.match(line)
+                if not m:
+                    continue
+                for (field, value) in zip(fields, m.groups()):
+                    if value is None:
+                        continue
+                    if value.isdigit():
+                        value = int(value)
+                    else:
+                        value = float(value)
+                    if field.startswith('+'):
+                        field = field[1:]
+                        value += target.get(field, 0)
+                    target[field] = value
+
+        def _add_derived(self, result):
+            log = result.get('log', {})
+            if 'log_bytes_written' in log:
+                if 'log_bytes_flushed' in log:
+                    log['unflushed_log'] = log['log_bytes_written'] - \
+                                           log['log_bytes_flushed']
+                if 'last_checkpoint' in log:
+                    log['uncheckpointed_bytes'] = log['log_bytes_written'] - \
+                                                  log['last_checkpoint']
+            transactions = result['transactions']
+            if 'innodb_transactions' in transactions and \
+               'purged_txns' in transactions:
+                transactions['unpurged_txns'] = \
+                    transactions['innodb_transactions'] - \
+                    transactions['purged_txns']
+            insert_buffer = result.get('insert_buffer', {})
+            if 'ibuf_inserts' in insert_buffer:
+                insert_buffer['ibuf_merged'] = insert_buffer['ibuf_inserts'] + \
+                    insert_buffer['ibuf_delete_marks'] + \
+                    insert_buffer['ibuf_deletes']
+            if 'ibuf_discarded_inserts' in insert_buffer:
+                insert_buffer['ibuf_discarded'] = \
+                    insert_buffer['ibuf_discarded_inserts'] + \
+                    insert_buffer['ibuf_discarded_delete_marks'] + \
+                    insert_buffer['ibuf_discarded_deletes']
+            row_ops = result.get('row_ops', {})
+            if row_ops.get('fd_total'):
+                row_ops['fd_used_percent'] = row_ops['fd_used'] * 100 / \
+                                             row_ops['fd_total']
+
+        def _get_discovery(self, rows):
+            ''' Per instance buffer pool sections are only reported when
+                there are several instances '''
+            instances = 1
+            for (name, value) in rows:
+                instances = int(value)
+            if instances < 2:
+                return []
+            return [ {'{#MYSQLBUFFERPOOL}': 'buffer_pool_%d' % instance}
+                     for instance in range(instances) ]
+
+        def _get_status(self, rows=None):
+            if rows is None:
+                rows = self.server._run_queries(['innodb_status'])['innodb_status']
+            result = {}
+            for (status_item) in rows:
+                result = self._parse(status_item[2])
             return result
 
         def _filter_status(self, item):
@@ -850,28 +841,327 @@ class MysqlServer(protobix.SampleProbe):
                 return (key, item[1])
             return (False, False)
 
-        def _is_enabled(self):
-            cursor = self.server.cnx.cursor()
-            cursor.execute("SHOW STATUS LIKE 'wsrep_ready'")
-            for (item) in cursor:
+        def _is_enabled(self, rows=None):
+            if rows is None:
+                rows = self.server._run_queries(['wsrep_ready'])['wsrep_ready']
+            for (item) in rows:
                 if item[0] == 'wsrep_ready' and item[1] == 'ON':
                     return True
             return False
 
-    ''' Replication class (multi source ready) '''
+    ''' Replication class (multi source ready)
+    Optional heartbeat mode, compatible with pt-heartbeat --utc tables:
+    primaries write a microsecond UTC timestamp row per server_id, replicas
+    compare the row of each channel master with their own clock.
+    '''
     class Replication(object):
 
-        def __init__(self, server):
+        def __init__(self, server, heartbeat_table=None):
             self.server = server
-
-        def _get_status(self):
+            self.heartbeat_table = heartbeat_table
+
+        def _start_heartbeat_writer(self, interval):
+            ''' Heartbeats are written by a daemon thread, over its own
+                connection, independently of the collection interval '''
+            writer = threading.Thread(target=self._write_heartbeats,
+                                      args=(self.server._get_config(), interval))
+            writer.daemon = True
+            writer.start()
+
+        def _write_heartbeats(self, config, interval):
+            cnx = None
+            while True:
+                started = time.time()
+                try:
+                    if cnx is None:
+                        cnx = mysql.connector.connect(**config)
+                        cursor = cnx.cursor()
+                        cursor.execute(MYSQL_SERVER_ID_QUERY)
+                        server_id = int(cursor.fetchone()[0])
+                        cursor.close()
+                    cursor = cnx.cursor()
+                    cursor.execute(MYSQL_HEARTBEAT_UPDATE.format(
+                        self.heartbeat_table, server_id))
+                    cursor.close()
+                except Exception as e:
+                    ''' Keep writing once the server is back '''
+                    sys.stderr.write('mysql heartbeat update failed: '
+                                     '{0}\n'.format(e))
+                    if cnx is not None:
+                        try:
+                            cnx.close()
+                        except Exception:
+                            pass
+                        cnx = None
+                time.sleep(max(interval - (time.time() - started), 0))
+
+        def _get_heartbeat_lags(self):
+            ''' Return replication lag in seconds, by master server_id '''
             cursor = self.server.cnx.cursor()
-            cursor.execute("SHOW ALL SLAVES STATUS")
+            cursor.execute(MYSQL_HEARTBEAT_QUERY.format(self.heartbeat_table))
+            lags = dict([ (int(server_id), int(lag) / 1000000.0)
+                          for (server_id, lag) in cursor
+                          if lag is not None ])
+            cursor.close()
+            return lags
+
+        def _get_status(self, rows=None):
+            if rows is None:
+                rows = self.server._run_queries(['replication'])['replication']
             replication_list=[]
-            for (replication_item) in cursor:
+            for (replication_item) in rows:
               replication_list.append(dict(zip(replication_keys,replication_item)))
             return replication_list
 
+    ''' Statement digest class
+    Ref: https://mariadb.com/kb/en/mariadb/performance-schema-events_statements_summary_by_digest-table/
+    Per digest deltas are computed against the previous run, persisted in
+    the state directory. Only the top N digests by latency, rows examined
+    or calls are exported.
+    '''
+    class Digest(object):
+
+        def __init__(self, server, top):
+            self.server = server
+            self.top = top
+            self.state_name = 'digest'
+
+        def _push(self, heap, item):
+            ''' Keep heap bounded to the top N items '''
+            if len(heap) < self.top:
+                heapq.heappush(heap, item)
+            elif item[0] > heap[0][0]:
+                heapq.heappushpop(heap, item)
+
+        def _get_status(self):
+            previous = self.server._load_state(self.state_name).get('digests', {})
+            current = {}
+            heaps = dict([ (field, []) for field in MYSQL_DIGEST_TOP_FIELDS ])
+            ''' Unbuffered cursor: rows are streamed, not fetched at once '''
+            cursor = self.server.cnx.cursor()
+            try:
+                cursor.execute(MYSQL_DIGEST_QUERY, (MYSQL_DIGEST_TEXT_LEN,))
+            except mysql.connector.DatabaseError as e:
+                ''' performance_schema disabled or missing: skip digests,
+                    keep previous state and other metrics '''
+                sys.stderr.write('mysql digest on {0} skipped: {1}\n'.format(
+                    self.server.hostname, e))
+                cursor.close()
+                return {}
+            for (schema, digest, text, calls, latency,
+                 rows_examined, rows_sent) in cursor:
+                key = '%s:%s' % (schema or '', digest)
+                values = [int(calls), int(latency),
+                          int(rows_examined), int(rows_sent)]
+                current[key] = values
+                prev_values = previous.get(key)
+                if prev_values is None or prev_values[0] > values[0]:
+                    ''' New digest, or summary table truncated '''
+                    continue
+                deltas = dict(zip(MYSQL_DIGEST_FIELDS,
+                                  [ value - prev_value for (value, prev_value)
+                                    in zip(values, prev_values) ]))
+                if not deltas['calls']:
+                    continue
+                for field in MYSQL_DIGEST_TOP_FIELDS:
+                    if deltas[field] > 0:
+                        self._push(heaps[field], (deltas[field], key, text, deltas))
+            cursor.close()
+
+            top = {}
+            for field in heaps:
+                for (value, key, text, deltas) in heaps[field]:
+                    top[key] = (text, deltas)
+            for key in top:
+                ''' Timers are in picoseconds, export milliseconds '''
+                deltas = top[key][1]
+                deltas['latency'] = deltas['latency'] / 1000000000.0
+            self.server._save_state(self.state_name, {
+                'digests': current,
+                'top': [ (key, top[key][0]) for key in top ]
+            })
+            return top
+
+        def _get_discovery(self):
+            data = []
+            for (key, text) in self.server._load_state(self.state_name).get('top', []):
+                (schema, digest) = key.split(':', 1)
+                data.append({ '{#MYSQLDIGEST}': key,
+                              '{#MYSQLDIGESTSCHEMA}': schema,
+                              '{#MYSQLDIGESTTEXT}': text })
+            return data
+
+    ''' Table size class
+    Schemas are scanned a few at a time, round-robin, so that the cost of
+    each run stays bounded whatever the catalog size. Sizes of schemas not
+    scanned during current run come from the previous runs.
+    '''
+    class TableSize(object):
+
+        def __init__(self, server, schemas_per_run, top):
+            self.server = server
+            self.schemas_per_run = schemas_per_run
+            self.top = top
+            self.state_name = 'table_sizes'
+
+        def _get_schemas(self):
+            cursor = self.server.cnx.cursor()
+            cursor.execute(MYSQL_SCHEMAS_QUERY)
+            schemas = sorted([ schema for (schema,) in cursor
+                               if schema not in MYSQL_SCHEMAS_BL ])
+            cursor.close()
+            return schemas
+
+        def _scan_schema(self, schema):
+            ''' Return schema totals and its top N tables by size '''
+            result = { 'data_size': 0, 'index_size': 0, 'tables': [] }
+            heap = []
+            cursor = self.server.cnx.cursor()
+            cursor.execute(MYSQL_TABLES_QUERY, (schema,))
+            for (table, data_size, index_size) in cursor:
+                data_size = int(data_size or 0)
+                index_size = int(index_size or 0)
+                result['data_size'] += data_size
+                result['index_size'] += index_size
+                item = (data_size + index_size, table, data_size, index_size)
+                if len(heap) < self.top:
+                    heapq.heappush(heap, item)
+                elif item[0] > heap[0][0]:
+                    heapq.heappushpop(heap, item)
+            cursor.close()
+            result['tables'] = [ (table, data_size, index_size) for
+                                 (size, table, data_size, index_size) in heap ]
+            return result
+
+        def _get_status(self):
+            state = self.server._load_state(self.state_name)
+            sizes = state.get('schemas', {})
+            schemas = self._get_schemas()
+            ''' Forget dropped schemas '''
+            for schema in sizes.keys():
+                if schema not in schemas:
+                    del sizes[schema]
+            ''' Resume after the last schema scanned by previous run '''
+            last = state.get('last')
+            start = 0
+            for index in range(len(schemas)):
+                if schemas[index] > last:
+                    start = index
+                    break
+            for index in range(min(self.schemas_per_run, len(schemas))):
+                schema = schemas[(start + index) % len(schemas)]
+                sizes[schema] = self._scan_schema(schema)
+                last = schema
+            self.server._save_state(self.state_name, {
+                'schemas': sizes,
+                'last': last
+            })
+            return sizes
+
+        def _get_top_tables(self, sizes):
+            tables = []
+            for schema in sizes:
+                for (table, data_size, index_size) in sizes[schema]['tables']:
+                    tables.append((data_size + index_size, schema, table,
+                                   data_size, index_size))
+            return heapq.nlargest(self.top, tables)
+
+        def _get_discovery(self):
+            sizes = self.server._load_state(self.state_name).get('schemas', {})
+            schemas = [ { '{#MYSQLSCHEMA}': schema } for schema in sizes ]
+            tables = []
+            for (size, schema, table, data_size, index_size) in \
+                    self._get_top_tables(sizes):
+                tables.append({ '{#MYSQLSCHEMA}': schema,
+                                '{#MYSQLTABLE}': table })
+            return (schemas, tables)
+
+    ''' Processlist class
+    Threads are sampled several times per run, one lightweight query per
+    sample, and only aggregates are exported: average number of threads per
+    state, command, user and host, and a cumulative histogram of running
+    query ages. Dimension values seen by previous runs are kept in the
+    state directory, so that values which disappeared are reported as 0.
+    '''
+    class Processlist(object):
+
+        def __init__(self, server, samples, interval):
+            self.server = server
+            self.samples = samples
+            self.interval = interval
+            self.state_name = 'processlist'
+
+        def _sample(self):
+            cursor = self.server.cnx.cursor()
+            cursor.execute(MYSQL_PROCESSLIST_QUERY)
+            rows = cursor.fetchall()
+            cursor.close()
+            return rows
+
+        def _get_status(self):
+            counters = dict([ (dimension, {}) for dimension
+                              in MYSQL_PROCESSLIST_DIMENSIONS ])
+            ages = dict([ (bucket, 0) for bucket
+                          in MYSQL_PROCESSLIST_AGE_BUCKETS ])
+            ages['inf'] = 0
+            max_age = 0
+            for sample in range(self.samples):
+                if sample:
+                    time.sleep(self.interval)
+                for row in self._sample():
+                    for (dimension, value) in \
+                            zip(MYSQL_PROCESSLIST_DIMENSIONS, row):
+                        value = value or 'none'
+                        counters[dimension][value] = \
+                            counters[dimension].get(value, 0) + 1
+                    (command, age) = (row[1], int(row[4] or 0))
+                    if command in MYSQL_PROCESSLIST_IDLE_COMMANDS:
+                        continue
+                    max_age = max(max_age, age)
+                    for bucket in MYSQL_PROCESSLIST_AGE_BUCKETS:
+                        if age <= bucket:
+                            ages[bucket] += 1
+                    ages['inf'] += 1
+            ''' Known values, with last time they were seen '''
+            now = int(time.time())
+            known = {}
+            for (dimension, value, seen) in \
+                    self.server._load_state(self.state_name).get('values', []):
+                if now - seen < MYSQL_PROCESSLIST_VALUES_TTL:
+                    known[(dimension, value)] = seen
+            result = {}
+            for (dimension, value) in known:
+                result[(dimension, value)] = 0
+            for dimension in counters:
+                for value in counters[dimension]:
+                    known[(dimension, value)] = now
+                    result[(dimension, value)] = \
+                        round(counters[dimension][value] / float(self.samples), 2)
+            self.server._save_state(self.state_name, {
+                'values': [ (dimension, value, known[(dimension, value)])
+                            for (dimension, value) in known ]
+            })
+            for bucket in ages:
+                result[('age', 'le_%s' % bucket)] = \
+                    round(ages[bucket] / float(self.samples), 2)
+            result[('age', 'max')] = max_age
+            return result
+
+        def _get_discovery(self):
+            data = []
+            values = set([ (dimension, value) for (dimension, value, seen) in
+                           self.server._load_state(self.state_name).get('values', []) ])
+            if not values:
+                ''' No metrics run yet: discover values of a single sample '''
+                for row in self._sample():
+                    for (dimension, value) in \
+                            zip(MYSQL_PROCESSLIST_DIMENSIONS, row):
+                        values.add((dimension, value or 'none'))
+            for (dimension, value) in values:
+                data.append({ '{#MYSQLPLDIMENSION}': dimension,
+                              '{#MYSQLPLVALUE}': value })
+            return data
+
     ''' Cassandra class
     Ref: https://mariadb.com/kb/en/mariadb/documentation/storage-engines/storage-engines-cassandra-storage-engine/cassandra-status-variables/
         Cassandra_multiget_keys_scanned : numeric
@@ -1171,7 +1461,56 @@ class MysqlServer(protobix.SampleProbe):
                 return (key, item[1])
             return (False, False)
 
-    def _get_engines(self):
+    def _get_state_path(self, name):
+        ''' Several local instances may share host and port but not socket '''
+        instance = '{0}_{1}'.format(self.options.host, self.options.port)
+        if self.options.socket:
+            instance = re.sub(r'[^\w.-]', '_', self.options.socket)
+        filename = 'zabbix_mysql_server_{0}_{1}.json'.format(instance, name)
+        return os.path.join(self.options.state_dir, filename)
+
+    def _load_state(self, name):
+        ''' Return data saved by previous run, empty dict if none.
+            Files not owned by the current user are ignored. '''
+        try:
+            with open(self._get_state_path(name), 'r') as f:
+                if os.fstat(f.fileno()).st_uid != os.getuid():
+                    return {}
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save_state(self, name, state):
+        ''' Concurrent runs each write their own temporary file '''
+        path = self._get_state_path(name)
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.options.state_dir,
+                                          prefix=os.path.basename(path) + '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp_path, path)
+        except:
+            os.unlink(tmp_path)
+            raise
+
+    def _run_queries(self, names):
+        """ Run MYSQL_QUERIES statements in a single multi-statement round
+            trip. Returns result rows indexed by query name """
+        results = {}
+        statements = ';'.join([ MYSQL_QUERIES[name] for name in names ])
+        cursor = self._get_cursor(statements)
+        index = 0
+        for result in cursor.execute(statements, multi=True):
+            rows = []
+            if result.with_rows:
+                rows = result.fetchall()
+            results[names[index]] = rows
+            index += 1
+        if not self.options.persistent:
+            cursor.close()
+        return results
+
+    def _get_engines(self, rows=None):
         covered_engines = [
             'innodb',
             'aria',
@@ -1181,9 +1520,9 @@ class MysqlServer(protobix.SampleProbe):
             'spider'
         ]
         enabled_engines = []
-        cursor = self.cnx.cursor()
-        cursor.execute("SHOW ENGINES")
-        for engine_item in cursor:
+        if rows is None:
+            rows = self._run_queries(['engines'])['engines']
+        for engine_item in rows:
             if engine_item[0].lower() in covered_engines:
                 enabled_engines.append(engine_item[0].lower())
 
@@ -1195,11 +1534,71 @@ class MysqlServer(protobix.SampleProbe):
             return(False, False)
         return (key, item[1])
 
-    def _get_status(self):
+    def _get_rates(self, rows):
+        ''' Compute rates against the sample saved by previous run.
+            No rate is returned on first run or after a server restart,
+            detected with uptime going backwards. '''
+        sample = { 'time': time.time(), 'counters': {} }
+        for status_item in rows:
+            key = status_item[0].lower()
+            if key in self.rate_counters or key == 'uptime':
+                try:
+                    sample['counters'][key] = int(status_item[1])
+                except (TypeError, ValueError):
+                    pass
+        previous = self._load_state('rates')
+        self._save_state('rates', sample)
+
+        rates = {}
+        if not previous:
+            return rates
+        counters = sample['counters']
+        prev_counters = previous['counters']
+        if counters.get('uptime', 0) < prev_counters.get('uptime', 0):
+            return rates
+        elapsed = sample['time'] - previous['time']
+        if elapsed <= 0:
+            return rates
+        for key in counters:
+            if key == 'uptime' or key not in prev_counters:
+                continue
+            delta = counters[key] - prev_counters[key]
+            if delta >= 0:
+                rates[key] = round(delta / elapsed, 3)
+        return rates
+
+    def _get_plugins_dispatch(self):
+        ''' Index plugins by the first token of their status prefix
+            so that each status item is classified with a single lookup '''
+        dispatch = {}
+        for plugin_name in self.plugins:
+            prefix = self.plugins[plugin_name].status_prefix
+            token = prefix.split('_', 1)[0]
+            dispatch.setdefault(token, []).append((prefix, plugin_name))
+        return dispatch
+
+    def _get_plugin_name(self, status_name):
+        token = status_name.split('_', 1)[0]
+        for (prefix, plugin_name) in self.plugins_dispatch.get(token, ()):
+            if status_name.startswith(prefix):
+                return plugin_name
+        return None
+
+    def _get_status(self, rows=None):
         global_status = {}
-        cursor = self.cnx.cursor()
-        cursor.execute("SHOW GLOBAL STATUS")
-        for status_item in cursor:
+        for plugin_name in self.plugins:
+            global_status[plugin_name] = {}
+        if rows is None:
+            rows = self._run_queries(['status'])['status']
+        for status_item in rows:
+            ''' Find wether current item belongs to a plugin '''
+            plugin_name = self._get_plugin_name(status_item[0])
+            if plugin_name is not None:
+                (key, value) = self.plugins[plugin_name]._filter_status(status_item)
+                if key and value:
+                    global_status[plugin_name][key] = value
+                continue
+
             ''' Filter Global status '''
             (key, value) = self._filter_status(status_item)
             if key and value:
@@ -1207,21 +1606,6 @@ class MysqlServer(protobix.SampleProbe):
                     value = MYSQL_INNODB_MAPPING[value]
                 global_status[key] = value
 
-            ''' Find wether current item belongs to a plugin '''
-            for plugin_name in self.plugins:
-                if plugin_name not in global_status:
-                    global_status[plugin_name] = {}
-                plugin = self.plugins[plugin_name]
-                prefix = plugin.status_prefix
-                if status_item[0].startswith(prefix):
-                    ''' Filter Innodb results '''
-                    (key, value) = plugin._filter_status(status_item)
-                    if key and value:
-                        global_status[plugin_name][key] = value
-                    ''' unset global status key if belong to plugin '''
-                    if status_item[0].lower() in global_status:
-                        del global_status[status_item[0].lower()]
-
         return global_status
 
     def _parse_args(self):
@@ -1241,22 +1625,194 @@ class MysqlServer(protobix.SampleProbe):
                                    help='MySQL server password')
         general_options.add_option('--database', default='mysql',
                                    help='MySQL server database')
+        general_options.add_option('--socket', default=None,
+                                   help='MySQL server UNIX socket')
+        general_options.add_option('--targets', default=None,
+                                   help='YAML file listing MySQL instances to '
+                                        'collect concurrently')
+        general_options.add_option('--workers', default=4, type='int',
+                                   help='Number of instances collected '
+                                        'concurrently')
+        general_options.add_option('--target-timeout', default=10, type='int',
+                                   help='Per instance timeout, in seconds')
+        general_options.add_option('--persistent', action='store_true',
+                                   default=False,
+                                   help='Keep MySQL connections open between '
+                                        'runs of a long running process')
+        general_options.add_option('--daemon-interval', default=0, type='float',
+                                   help='Run forever, collecting every N '
+                                        'seconds (implies --persistent)')
+        general_options.add_option('--heartbeat-table', default=None,
+                                   help='Heartbeat table (db.table) used to '
+                                        'measure replication lag')
+        general_options.add_option('--heartbeat-update', action='store_true',
+                                   default=False,
+                                   help='Write this server heartbeat, for '
+                                        'primaries, from a background thread. '
+                                        'Requires --daemon-interval, otherwise '
+                                        'use pt-heartbeat --utc to write '
+                                        'heartbeats')
+        general_options.add_option('--heartbeat-interval',
+                                   default=MYSQL_HEARTBEAT_INTERVAL,
+                                   type='float',
+                                   help='Delay between heartbeat writes, in '
+                                        'seconds')
+        general_options.add_option('--state-dir', default=None,
+                                   help='Directory where samples from previous '
+                                        'run are kept. Defaults to a private '
+                                        'directory in %s' % MYSQL_STATE_BASE_DIR)
+        general_options.add_option('--rates', action='store_true', default=False,
+                                   help='Export per second rates of status '
+                                        'counters')
+        general_options.add_option('--rate-counters', default=None,
+                                   help='Comma separated status counters '
+                                        'exported as rates (implies --rates)')
+        general_options.add_option('--table-sizes', default=0, type='int',
+                                   help='Number of schemas scanned per run for '
+                                        'schema and table sizes (0 to disable)')
+        general_options.add_option('--table-sizes-top', default=20, type='int',
+                                   help='Number of largest tables exported')
+        general_options.add_option('--processlist-samples', default=0,
+                                   type='int',
+                                   help='Number of processlist samples '
+                                        'aggregated per run (0 to disable)')
+        general_options.add_option('--processlist-interval', default=1.0,
+                                   type='float',
+                                   help='Delay between processlist samples, '
+                                        'in seconds')
+        general_options.add_option('--digest-top', default=0, type='int',
+                                   help='Export top N statement digests from '
+                                        'performance_schema (0 to disable)')
         parser.add_option_group(general_options)
 
         (options, args) = parser.parse_args()
+        if options.heartbeat_update and not options.daemon_interval > 0:
+            parser.error('--heartbeat-update requires --daemon-interval, '
+                         'use pt-heartbeat --utc otherwise')
+        if options.heartbeat_update and not options.heartbeat_table:
+            parser.error('--heartbeat-update requires --heartbeat-table')
+        if options.daemon_interval:
+            options.persistent = True
+        if options.state_dir is None:
+            options.state_dir = self._get_private_state_dir()
+            if options.state_dir is None:
+                parser.error('%s/zabbix-mysql-server-%d is not a private '
+                             'directory, use --state-dir'
+                             % (MYSQL_STATE_BASE_DIR, os.getuid()))
         return (options, args)
 
+    def _get_private_state_dir(self):
+        ''' Return a 0700 directory owned by the current user, None if it
+            cannot be trusted '''
+        path = os.path.join(MYSQL_STATE_BASE_DIR,
+                            'zabbix-mysql-server-%d' % os.getuid())
+        try:
+            os.mkdir(path, 0700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                return None
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+                stat.S_IMODE(st.st_mode) & 0077:
+            return None
+        return path
+
     def _init_probe(self):
         self.hostname = socket.getfqdn()
-        self.config = {
+        self.targets = []
+        if self.options.targets:
+            ''' Multi-target mode: instances are connected by worker threads '''
+            with open(self.options.targets, 'r') as f:
+                self.targets = yaml.load(f)['targets']
+        else:
+            self._connect()
+        self._init_instance()
+
+    def _get_config(self):
+        config = {
           'user': self.options.username,
           'password': self.options.password,
           'host': self.options.host,
-          'database': self.options.database
+          'port': int(self.options.port),
+          'database': self.options.database,
+          'connection_timeout': self.options.target_timeout,
+          # Never keep a transaction snapshot open between reads, nor
+          # between runs of persistent connections
+          'autocommit': True
         }
-        self.cnx = mysql.connector.connect(**self.config)
+        if self.options.socket:
+            config['unix_socket'] = self.options.socket
+        return config
+
+    def _connect(self):
+        self.config = self._get_config()
+        self.cnx_key = tuple(sorted(self.config.items()))
+        self.cnx = None
+        if self.options.persistent:
+            (self.cnx, self.cursors) = \
+                MYSQL_CONNECTIONS.pop(self.cnx_key, (None, {}))
+        if self.cnx is not None:
+            try:
+                self.cnx.ping()
+            except mysql.connector.Error:
+                ''' Server restarted or connection timed out '''
+                self.cnx.reconnect()
+                self.cursors = {}
+        else:
+            self.cnx = mysql.connector.connect(**self.config)
+            self.cursors = {}
+
+    def _get_cursor(self, statement):
+        ''' With --persistent, cursors of fixed statements are reused '''
+        if not self.options.persistent:
+            return self.cnx.cursor()
+        if statement not in self.cursors:
+            self.cursors[statement] = self.cnx.cursor()
+        return self.cursors[statement]
+
+    def _release(self):
+        if self.options.persistent:
+            MYSQL_CONNECTIONS[self.cnx_key] = (self.cnx, self.cursors)
+        else:
+            self.cnx.close()
+
+    def _discard(self):
+        ''' Close the connection and never hand it out again '''
+        MYSQL_CONNECTIONS.pop(self.cnx_key, None)
+        if self.cnx is not None:
+            try:
+                self.cnx.close()
+            except mysql.connector.Error:
+                pass
+            self.cnx = None
+            self.cursors = {}
+
+    def _call_instance(self, method_name):
+        ''' A failed query leaves the connection and its cursors in an
+            unknown state: drop it rather than reuse it next cycle '''
+        try:
+            return getattr(self, method_name)()
+        except Exception:
+            self._discard()
+            raise
+
+    def _init_instance(self):
         ''' Initialize sub-classes '''
-        self.replication = self.Replication(self)
+        self.replication = self.Replication(self, self.options.heartbeat_table)
+        self.digest = self.Digest(self, self.options.digest_top)
+        self.table_size = self.TableSize(self, self.options.table_sizes,
+                                         self.options.table_sizes_top)
+        self.processlist = self.Processlist(self,
+                                            self.options.processlist_samples,
+                                            self.options.processlist_interval)
+        self.rate_counters = set()
+        if self.options.rate_counters:
+            self.rate_counters = set(self.options.rate_counters.lower().split(','))
+        elif self.options.rates:
+            self.rate_counters = set(MYSQL_RATE_COUNTERS)
         self.plugins = {
             'galera' : self.Galera(self),
             'innodb' : self.Innodb(self),
@@ -1267,6 +1823,7 @@ class MysqlServer(protobix.SampleProbe):
             'serveraudit' : self.ServerAudit(self),
             'spider' : self.Spider(self)
         }
+        self.plugins_dispatch = self._get_plugins_dispatch()
         self.galera = self.Galera(self)
         self.innodb = self.Innodb(self)
         self.aria = self.Aria(self)
@@ -1277,6 +1834,11 @@ class MysqlServer(protobix.SampleProbe):
         self.spider = self.Spider(self)
         ''' Initialize variables '''
         self.repl_discovery_key = 'mysql.server.replication.discovery'
+        self.digest_discovery_key = 'mysql.server.digest.discovery'
+        self.schema_discovery_key = 'mysql.server.schema.discovery'
+        self.table_discovery_key = 'mysql.server.table.discovery'
+        self.processlist_discovery_key = 'mysql.server.processlist.discovery'
+        self.buffer_pool_discovery_key = 'mysql.server.buffer_pool.discovery'
         self.galera_discovery_key = 'mysql.server.plugins[galera,discovery]'
         self.innodb_discovery_key = 'mysql.server.plugins[innodb,discovery]'
         self.aria_discovery_key = 'mysql.server.plugins[aria,discovery]'
@@ -1286,35 +1848,124 @@ class MysqlServer(protobix.SampleProbe):
         self.serveraudit_discovery_key = 'mysql.server.plugins[serveraudit,discovery]'
         self.spider_discovery_key = 'mysql.server.plugins[spider,discovery]'
 
+    def _get_target_probe(self, target):
+        ''' Return a copy of this probe bound to a target of the config file '''
+        probe = copy.copy(self)
+        probe.options = copy.copy(self.options)
+        for option in MYSQL_TARGET_OPTIONS:
+            if option in target:
+                setattr(probe.options, option, target[option])
+        probe.hostname = self._get_target_hostname(target)
+        probe.targets = []
+        probe._init_instance()
+        return probe
+
+    def _get_target_hostname(self, target):
+        return target.get('name', target.get('host', self.options.host))
+
+    def _collect_target(self, target, method_name):
+        probe = self._get_target_probe(target)
+        probe._connect()
+        return (probe.hostname, probe._call_instance(method_name))
+
+    def _collect_targets(self, method_name, status_key=None):
+        ''' Collect all targets concurrently with a bounded worker pool.
+            A target failing or exceeding its timeout is logged on stderr
+            and skipped. If status_key is set, every target reports it,
+            1 if collected and 0 otherwise. '''
+        pool = ThreadPool(min(self.options.workers, len(self.targets)))
+        results = []
+        for target in self.targets:
+            results.append(pool.apply_async(self._collect_target,
+                                            (target, method_name)))
+        ''' Worker threads are daemons: do not wait for hung ones '''
+        pool.close()
+        rounds = (len(self.targets) - 1) / self.options.workers + 1
+        deadline = time.time() + self.options.target_timeout * rounds
+        data = {}
+        for (target, result) in zip(self.targets, results):
+            hostname = self._get_target_hostname(target)
+            try:
+                (hostname, target_data) = result.get(
+                    max(deadline - time.time(), 0))
+            except Exception as e:
+                sys.stderr.write('mysql target {0} failed: {1}\n'.format(
+                    hostname, str(e) or e.__class__.__name__))
+                if status_key:
+                    data[hostname] = { status_key: 0 }
+                continue
+            if status_key:
+                target_data[status_key] = 1
+            data[hostname] = target_data
+        return data
+
     def _get_discovery(self):
+        if self.targets:
+            return self._collect_targets('_get_instance_discovery')
+        return { self.hostname:
+                 self._call_instance('_get_instance_discovery') }
+
+    def _get_metrics(self):
+        if self.targets:
+            return self._collect_targets('_get_instance_metrics',
+                                         'mysql.server.target_status')
+        return { self.hostname:
+                 self._call_instance('_get_instance_metrics') }
+
+    def _get_instance_discovery(self):
         data = {
             self.repl_discovery_key:[],
         }
+        results = self._run_queries(['engines', 'wsrep_ready', 'replication',
+                                     'buffer_pool_instances'])
         ''' Perform storage engines LLD ops '''
-        engines_list = self._get_engines()
+        engines_list = self._get_engines(results['engines'])
         for engine in engines_list:
             data['mysql.server.plugins['+engine+',discovery]'] = [{'{#MYSQLACTIVEPLUGIN}': engine}]
 
+        ''' Perform InnoDB buffer pool instances LLD ops '''
+        data[self.buffer_pool_discovery_key] = \
+            self.innodb._get_discovery(results['buffer_pool_instances'])
+
         ''' Galera is not a storage engine '''
-        if self.galera._is_enabled():
+        if self.galera._is_enabled(results['wsrep_ready']):
             data['mysql.server.plugins[galera,discovery]'] = [{'{#MYSQLACTIVEPLUGIN}': 'galera'}]
 
         ''' Perform replication LLD ops '''
-        for replication in self.replication._get_status():
+        for replication in self.replication._get_status(results['replication']):
             replication_name=replication['connection_name']
             if(replication['connection_name']==""):
                 replication_name=replication['master_host']
             data[self.repl_discovery_key].append({'{#MYSQLREPNAME}': replication_name})
-        self.cnx.close()
-        return { self.hostname: data }
 
-    def _get_metrics(self):
+        ''' Perform statement digests LLD ops '''
+        if self.digest.top:
+            data[self.digest_discovery_key] = self.digest._get_discovery()
+
+        ''' Perform schemas and largest tables LLD ops '''
+        if self.table_size.schemas_per_run:
+            (schemas, tables) = self.table_size._get_discovery()
+            data[self.schema_discovery_key] = schemas
+            data[self.table_discovery_key] = tables
+
+        ''' Perform processlist aggregates LLD ops '''
+        if self.processlist.samples:
+            data[self.processlist_discovery_key] = \
+                self.processlist._get_discovery()
+        self._release()
+        return data
+
+    def _get_instance_metrics(self):
         data = {}
+        results = self._run_queries(['replication', 'status'])
         ''' Check Replication status
             Compatible with multi-source replication '''
-        replication_list=self.replication._get_status()
+        replication_list=self.replication._get_status(results['replication'])
         zbx_key = "mysql.server.replication.sources"
         data[zbx_key] = len(replication_list)
+        heartbeat_lags = {}
+        if self.replication.heartbeat_table and replication_list:
+            heartbeat_lags = self.replication._get_heartbeat_lags()
         for replication in replication_list:
           ''' For single source replication, connection name is not set
               In that case, we use master_host value as connection name '''
@@ -1346,10 +1997,33 @@ class MysqlServer(protobix.SampleProbe):
               replication[item] = 0
             data[zbx_key] = replication[item]
 
+          ''' report sub-second lag from channel master heartbeat '''
+          master_server_id = replication['master_server_id']
+          if master_server_id is not None and \
+                  int(master_server_id) in heartbeat_lags:
+            zbx_key = "mysql.server.replication[{0},heartbeat_lag]"
+            zbx_key = zbx_key.format(replication_name)
+            data[zbx_key] = heartbeat_lags[int(master_server_id)]
+
+        global_status = self._get_status(results['status'])
+
+        ''' Per second rates of status counters '''
+        if self.rate_counters:
+            rates = self._get_rates(results['status'])
+            for counter in rates:
+                zbx_key = "mysql.server.rate[{0}]"
+                zbx_key = zbx_key.format(counter)
+                data[zbx_key] = rates[counter]
+
         ''' Check Innodb status '''
-        '''
-        data['mysql.server.plugins[innodb,enabled]'] = 0
-        innodb_status=self.innodb.get_status()
+        data['mysql.server.plugins[innodb2,enabled]'] = 0
+        innodb_status = {}
+        if global_status['innodb']:
+            try:
+                innodb_status = self.innodb._get_status()
+            except mysql.connector.Error:
+                ''' PROCESS privilege is required '''
+                innodb_status = {}
         if len(innodb_status):
             data['mysql.server.plugins[innodb2,enabled]'] = 1
             for key in innodb_status:
@@ -1357,9 +2031,6 @@ class MysqlServer(protobix.SampleProbe):
                     zbx_key="mysql.server.plugins[innodb2,{0},{1}]"
                     zbx_key=zbx_key.format(key,subkey)
                     data[zbx_key]=innodb_status[key][subkey]
-        '''
-
-        global_status = self._get_status()
         for plugin in global_status:
             if type(global_status[plugin]) is dict:
                 ''' Plugins status informations '''
@@ -1378,11 +2049,64 @@ class MysqlServer(protobix.SampleProbe):
                 zbx_key=zbx_key.format(plugin)
                 data[zbx_key]=global_status[plugin]
 
-        self.cnx.close()
+        ''' Check statement digests '''
+        if self.digest.top:
+            top_digests = self.digest._get_status()
+            for key in top_digests:
+                (text, deltas) = top_digests[key]
+                for item in deltas:
+                    zbx_key = "mysql.server.digest[{0},{1}]"
+                    zbx_key = zbx_key.format(key, item)
+                    data[zbx_key] = deltas[item]
+
+        ''' Check schema and largest tables sizes '''
+        if self.table_size.schemas_per_run:
+            sizes = self.table_size._get_status()
+            for schema in sizes:
+                for item in ['data_size', 'index_size']:
+                    zbx_key = "mysql.server.schema[{0},{1}]"
+                    zbx_key = zbx_key.format(schema, item)
+                    data[zbx_key] = sizes[schema][item]
+            for (size, schema, table, data_size, index_size) in \
+                    self.table_size._get_top_tables(sizes):
+                zbx_key = "mysql.server.table[{0},{1},{2}]"
+                data[zbx_key.format(schema, table, 'data_size')] = data_size
+                data[zbx_key.format(schema, table, 'index_size')] = index_size
+
+        ''' Check processlist aggregates '''
+        if self.processlist.samples:
+            processlist = self.processlist._get_status()
+            for (dimension, value) in processlist:
+                zbx_key = "mysql.server.processlist[{0},{1}]"
+                zbx_key = zbx_key.format(dimension, value)
+                data[zbx_key] = processlist[(dimension, value)]
+
+        self._release()
         data['mysql.server.zbx_version'] = self.__version__
-        return { self.hostname: data }
+        return data
+
+    def _start_heartbeat_writers(self):
+        if not self.targets:
+            self.replication._start_heartbeat_writer(
+                self.options.heartbeat_interval)
+        for target in self.targets:
+            probe = self._get_target_probe(target)
+            probe.replication._start_heartbeat_writer(
+                self.options.heartbeat_interval)
+
+    def run(self):
+        ''' With --daemon-interval, keep running the probe, reusing MySQL
+            connections opened by previous runs '''
+        ret = super(MysqlServer, self).run()
+        if self.options.heartbeat_update:
+            self._start_heartbeat_writers()
+        while self.options.daemon_interval:
+            time.sleep(self.options.daemon_interval)
+            ret = super(MysqlServer, self).run()
+        return ret
 
 if __name__ == '__main__':
+    protobix.mark_started()
     ret = MysqlServer().run()
     print ret
     sys.exit(ret)
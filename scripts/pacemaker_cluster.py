@@ -7,12 +7,13 @@ import optparse
 import json
 import socket
 import subprocess
-import xmltodict
 import simplejson
 import sys
 
 import protobix
 
+xmltodict = protobix.LazyModule('xmltodict')
+
 class PacemakerCluster(protobix.SampleProbe):
 
     __version__ = '0.0.9'
@@ -129,6 +130,7 @@ class PacemakerCluster(protobix.SampleProbe):
         return { self.hostname: data }
 
 if __name__ == '__main__':
+    protobix.mark_started()
     ret = PacemakerCluster().run()
     print ret
     sys.exit(ret)
@@ -6,9 +6,13 @@
 import optparse
 import socket
 import ConfigParser
+import glob
 import simplejson
 import os
+import re
 import sys
+import time
+from multiprocessing.pool import ThreadPool
 
 import protobix
 
@@ -209,6 +213,8 @@ class Record(object):
         """Read and decode a Record from a socket."""
         try:
             header, length = self._recvall(sock, FCGI_HEADER_LEN)
+        except socket.timeout:
+            raise
         except:
             raise EOFError
 
@@ -228,6 +234,8 @@ class Record(object):
             try:
                 self.contentData, length = self._recvall(sock,
                                                          self.contentLength)
+            except socket.timeout:
+                raise
             except:
                 raise EOFError
 
@@ -237,6 +245,8 @@ class Record(object):
         if self.paddingLength:
             try:
                 self._recvall(sock, self.paddingLength)
+            except socket.timeout:
+                raise
             except:
                 raise EOFError
 
@@ -279,29 +289,69 @@ class Record(object):
 
 class FCGIApp(object):
 
-    def __init__(self, connect=None, host=None, port=None, filterEnviron=True):
+    def __init__(self, connect=None, host=None, port=None, filterEnviron=True,
+                 keepConn=False, timeout=None):
         if host is not None:
             assert port is not None
             connect = (host, port)
 
         self._connect = connect
         self._filterEnviron = filterEnviron
+        self._keepConn = keepConn
+        self._timeout = timeout
+        self._sock = None
+        self._requestId = 0
 
     def __call__(self, environ, start_response=None):
         # For sanity's sake, we don't care about FCGI_MPXS_CONN
-        # (connection multiplexing). For every request, we obtain a new
-        # transport socket, perform the request, then discard the socket.
-        # This is, I believe, how mod_fastcgi does things...
+        # (connection multiplexing). Requests are serialized: with keepConn,
+        # the transport socket is kept open for the next request (the
+        # application is asked to do the same with FCGI_KEEP_CONN),
+        # otherwise it is discarded after each request, like mod_fastcgi.
+        reused = self._sock is not None
+        try:
+            return self._request(environ)
+        except socket.timeout:
+            # Hung application: a new connection would not do better.
+            self.close()
+            raise
+        except:
+            # The connection state is unknown: never reuse it.
+            self.close()
+            if not reused:
+                raise
+        # The application may close a kept-alive connection at any time
+        # (e.g. a PHP-FPM worker recycled after pm.max_requests): retry
+        # once on a fresh connection.
+        try:
+            return self._request(environ)
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
 
-        sock = self._getConnection()
+    def _request(self, environ):
+        if self._sock is None:
+            self._sock = self._getConnection()
+            self._requestId = 0
+        sock = self._sock
 
-        # Since this is going to be the only request on this connection,
-        # set the request ID to 1.
-        requestId = 1
+        # Request IDs only need to be unique among the requests in flight
+        # on this connection: there is at most one.
+        self._requestId = self._requestId % 0xffff + 1
+        requestId = self._requestId
 
         # Begin the request
+        flags = 0
+        if self._keepConn:
+            flags = FCGI_KEEP_CONN
         rec = Record(FCGI_BEGIN_REQUEST, requestId)
-        rec.contentData = struct.pack(FCGI_BeginRequestBody, FCGI_RESPONDER, 0)
+        rec.contentData = struct.pack(FCGI_BeginRequestBody, FCGI_RESPONDER,
+                                      flags)
         rec.contentLength = FCGI_BeginRequestBody_LEN
         rec.write(sock)
 
@@ -354,10 +404,11 @@ class FCGIApp(object):
                 # TODO: Process appStatus/protocolStatus fields?
                 break
 
-        # Done with this transport socket, close it. (FCGI_KEEP_CONN was not
-        # set in the FCGI_BEGIN_REQUEST record we sent above. So the
-        # application is expected to do the same.)
-        sock.close()
+        # Without FCGI_KEEP_CONN in the FCGI_BEGIN_REQUEST record we sent
+        # above, the application is expected to close the transport socket
+        # too: we are done with it.
+        if not self._keepConn:
+            self.close()
 
         result = ''.join(result)
 
@@ -408,11 +459,13 @@ class FCGIApp(object):
             # application.
             if isinstance(self._connect, types.StringTypes):
                 sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(self._timeout)
                 sock.connect(self._connect)
             elif hasattr(socket, 'create_connection'):
-                sock = socket.create_connection(self._connect)
+                sock = socket.create_connection(self._connect, self._timeout)
             else:
                 sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.settimeout(self._timeout)
                 sock.connect(self._connect)
             return sock
 
@@ -505,17 +558,58 @@ class PhpFpm(protobix.SampleProbe):
       'total processes',
       'listen queue len'
     ]
-  
-    def _get_pool_page(self, url, connect=None, host=None, port=None):
+
+    ''' Per process fields of the full status page, aggregated into
+        percentiles over idle processes, whose last request is complete.
+        Durations are in microseconds, memory in bytes. '''
+    PHP_PROCESS_KEYS = [
+      'request duration',
+      'last request cpu',
+      'last request memory'
+    ]
+    PHP_PROCESS_PERCENTILES = [50, 95, 99]
+    ''' Upper bounds, in microseconds, of cumulative request duration
+        histogram buckets '''
+    PHP_PROCESS_DURATION_BUCKETS = [10000, 100000, 1000000, 10000000]
+    PHP_JSON_SEPARATORS = re.compile(r'[\s,]*')
+
+    ''' Delay, in seconds, between checks of a pool not yet picked up by
+        a worker '''
+    PHP_POLL_INTERVAL = 0.05
+
+    ''' Parsed pools config is cached until a pool file changes: the cache
+        key is built from pool files names and mtimes '''
+    CACHE_TTLS = { 'pools': 86400 }
+
+    def _get_fcgi_app(self, listen):
+        """ One keep-alive FastCGI client per listen address, shared by
+            every page requested from it during the run """
+        if listen not in self.fcgi_apps:
+            listen_array = listen.split(':')
+            if listen.isdigit():
+                listen_array = ['', listen]
+            if len(listen_array) > 1:
+                ''' host:port, or port only (all interfaces) '''
+                host = listen_array[0] or '127.0.0.1'
+                fcgi = FCGIApp(host=host, port=int(listen_array[1]),
+                               keepConn=True, timeout=self.options.timeout)
+            else:
+                fcgi = FCGIApp(connect=listen, keepConn=True,
+                               timeout=self.options.timeout)
+            self.fcgi_apps[listen] = fcgi
+        return self.fcgi_apps[listen]
+
+    def _close_fcgi_apps(self):
+        for listen in self.fcgi_apps:
+            self.fcgi_apps[listen].close()
+        self.fcgi_apps = {}
+
+    def _get_pool_page(self, listen, url, query='json'):
         """ load fastcgi page """
-        if host is not None:
-            assert port is not None
-            fcgi = FCGIApp(host=host,port=port)
-        else:
-            fcgi = FCGIApp(connect=connect)
+        fcgi = self._get_fcgi_app(listen)
         env = {
             'SCRIPT_FILENAME': url,
-            'QUERY_STRING': 'json',
+            'QUERY_STRING': query,
             'REQUEST_METHOD': 'GET',
             'SCRIPT_NAME': url,
             'REQUEST_URI': url,
@@ -534,29 +628,63 @@ class PhpFpm(protobix.SampleProbe):
         ret = fcgi(env, 0)
         return ret
 
-    def _get_pools_config(self):
-        f = []
+    def _get_pool_files(self):
+        """ Returns (path, mtime) of pool files, sorted by path """
+        pool_files = []
+        for pattern in self.options.pool_dirs.split(','):
+            for root_path in sorted(glob.glob(pattern)):
+                if not os.path.isdir(root_path):
+                    continue
+                for f in sorted(os.listdir(root_path)):
+                    path = os.path.join(root_path, f)
+                    if os.path.isfile(path):
+                        pool_files.append((path, os.stat(path).st_mtime))
+        return pool_files
+
+    def _parse_pools_config(self, *pool_files):
         pool_config = ConfigParser.ConfigParser()
-        root_path = '/etc/php5/fpm/pool.d'
-        poolfilelist = [
-            os.path.join(root_path, f) for f in
-            os.listdir(root_path)
-            if os.path.isfile(os.path.join(root_path, f))
-        ]
-        pool_config.read(poolfilelist)
-        pool_config_dict = simplejson.loads(simplejson.dumps(pool_config._sections))
+        pool_config.read([ path for (path, mtime) in pool_files ])
+        pool_config_dict = {}
+        for pool in pool_config._sections:
+            pool_config_dict[pool] = dict(pool_config._sections[pool])
+            pool_config_dict[pool].pop('__name__', None)
         return pool_config_dict
 
+    def _get_pools_config(self):
+        return self.cache.fetch('pools', self._parse_pools_config,
+                                *self._get_pool_files())
+
     def _parse_args(self):
         # Parse the script arguments
         # Common part
         parser = super( PhpFpm, self)._parse_args()
 
+        # PHP-FPM options
+        phpfpm_options = optparse.OptionGroup(parser, 'PHP-FPM Configuration')
+        phpfpm_options.add_option('--pool-dirs',
+                                  default='/etc/php5/fpm/pool.d,'
+                                          '/etc/php/*/fpm/pool.d',
+                                  help='Comma separated pool config '
+                                       'directories (globs allowed)')
+        phpfpm_options.add_option('--workers', default=8, type='int',
+                                  help='Number of pools polled concurrently')
+        phpfpm_options.add_option('--timeout', default=3, type='float',
+                                  help='Per pool timeout, in seconds')
+        phpfpm_options.add_option('--full', action='store_true',
+                                  default=False,
+                                  help='Aggregate per process statistics of '
+                                       'the full status page')
+        phpfpm_options.add_option('--slow-request', default=1.0, type='float',
+                                  help='Running request duration, in seconds, '
+                                       'above which a process is slow')
+        parser.add_option_group(phpfpm_options)
         (options, args) = parser.parse_args()
-        return parser.parse_args()
+        return (options, args)
 
     def _init_probe(self):
         self.hostname = socket.getfqdn()
+        self.fcgi_apps = {}
+        self.cache = protobix.ProbeCache('php_fpm', self.CACHE_TTLS)
 
     def _get_discovery(self):
         self.discovery_key = 'php-fpm.pools.discovery'
@@ -567,76 +695,168 @@ class PhpFpm(protobix.SampleProbe):
           data[self.discovery_key].append(element)
         return { self.hostname: data }
 
+    def _iter_processes(self, out, position):
+        """ Decode per process entries one at a time, from the opening
+            bracket of the processes list """
+        decoder = simplejson.JSONDecoder()
+        position = out.index('[', position) + 1
+        while True:
+            position = self.PHP_JSON_SEPARATORS.match(out, position).end()
+            if out[position] == ']':
+                break
+            (process, position) = decoder.raw_decode(out, position)
+            yield process
+
+    def _parse_full_status(self, out):
+        """ Return pool totals, and per process aggregates of a full
+            status page. Processes are streamed and never kept. """
+        position = out.find('"processes"')
+        if position < 0:
+            return (simplejson.loads(out), {})
+        pool_status = simplejson.loads(out[:position].rstrip().rstrip(',') + '}')
+        values = dict([ (key, []) for key in self.PHP_PROCESS_KEYS ])
+        buckets = [0] * (len(self.PHP_PROCESS_DURATION_BUCKETS) + 1)
+        processes = { 'idle': 0, 'running': 0, 'slow': 0 }
+        slow_request = self.options.slow_request * 1000000
+        for process in self._iter_processes(out, position):
+            if process['state'] != 'Idle':
+                ''' Request still in progress: duration is growing, cpu
+                    and memory are not reported yet '''
+                processes['running'] += 1
+                if process['request duration'] > slow_request:
+                    processes['slow'] += 1
+                continue
+            processes['idle'] += 1
+            if not process['requests']:
+                continue
+            ''' Last request aggregates only cover completed requests '''
+            for key in self.PHP_PROCESS_KEYS:
+                values[key].append(process[key])
+            ''' Cumulative buckets: le_inf counts every idle process '''
+            for index in range(len(self.PHP_PROCESS_DURATION_BUCKETS)):
+                if process['request duration'] <= \
+                        self.PHP_PROCESS_DURATION_BUCKETS[index]:
+                    buckets[index] += 1
+            buckets[-1] += 1
+        for key in self.PHP_PROCESS_KEYS:
+            values[key].sort()
+            for percentile in self.PHP_PROCESS_PERCENTILES:
+                name = '{0}_p{1}'.format(key.replace(' ', '_'), percentile)
+                processes[name] = 0
+                if values[key]:
+                    ''' Nearest rank percentile '''
+                    rank = (len(values[key]) * percentile + 99) / 100
+                    processes[name] = values[key][max(rank, 1) - 1]
+        for (bound, count) in zip(self.PHP_PROCESS_DURATION_BUCKETS + ['inf'],
+                                  buckets):
+            processes['request_duration_le_{0}'.format(bound)] = count
+        return (pool_status, processes)
+
+    def _get_pool_metrics(self, pool, pool_config):
+        data = {}
+        ''' Ping and status pages share the same connection '''
+        try:
+            code, headers, out, err = self._get_pool_page(
+                pool_config['listen'], pool_config['ping.path'])
+            code_only = int(code.split()[0])
+            zbx_key = 'php-fpm.pool.ping[{0}]'
+            zbx_key = zbx_key.format(pool)
+            data[zbx_key] = 0
+            if code_only == 200:
+                data[zbx_key] = 1
+        except:
+            ''' Unreachable or hung: do not wait for the status page too '''
+            return self._get_unreachable_pool_metrics(pool)
+        try:
+            query = 'json'
+            if self.options.full:
+                query = 'full&json'
+            code, headers, out, err = self._get_pool_page(
+                pool_config['listen'], pool_config['pm.status_path'], query)
+            code_only = int(code.split()[0])
+            zbx_key = 'php-fpm.pool.status[{0}]'
+            zbx_key = zbx_key.format(pool)
+            data[zbx_key] = 0
+            if code_only == 200:
+              data[zbx_key] = 1
+              if self.options.full:
+                (pool_status, processes) = self._parse_full_status(out)
+                for key in processes:
+                  zbx_key = 'php-fpm.pool.processes[{0},{1}]'
+                  zbx_key = zbx_key.format(pool, key)
+                  data[zbx_key] = processes[key]
+              else:
+                pool_status = simplejson.loads(out)
+              for key in self.PHP_POOL_STATUS_KEYS:
+                zbx_key = 'php-fpm.pool.status[{0},{1}]'
+                zbx_key = zbx_key.format(pool, key.replace(' ', '_'))
+                data[zbx_key] = pool_status[key]
+        except:
+            zbx_key = 'php-fpm.pool.status[{0}]'
+            zbx_key = zbx_key.format(pool)
+            data[zbx_key] = 0
+            pass
+        return data
+
+    def _get_unreachable_pool_metrics(self, pool):
+        data = {}
+        for item in ['ping', 'status']:
+            zbx_key = 'php-fpm.pool.{0}[{1}]'
+            zbx_key = zbx_key.format(item, pool)
+            data[zbx_key] = 0
+        return data
+
+    def _poll_pool(self, pool, pool_config, started):
+        started[pool] = time.time()
+        return self._get_pool_metrics(pool, pool_config)
+
+    def _wait_pool(self, pool, result, started, budget, cap):
+        """ Wait for a pool until its own deadline, which starts when a
+            worker picks it up: pools queued behind a hung one are not
+            penalized. cap bounds the whole run. """
+        deadline = None
+        while not result.ready():
+            if deadline is None and pool in started:
+                deadline = started[pool] + budget
+            remaining = min(deadline or cap, cap) - time.time()
+            if remaining <= 0:
+                break
+            if deadline is None:
+                ''' Not started yet: check again shortly '''
+                remaining = min(remaining, self.PHP_POLL_INTERVAL)
+            result.wait(remaining)
+        return result.get(0)
+
     def _get_metrics(self):
+        """ Pools are polled concurrently by a bounded worker pool.
+            A pool hung past its timeout is reported down, without
+            delaying the others. """
         data = {}
         pool_list = self._get_pools_config()
+        if not pool_list:
+            data['php-fpm.zbx_version'] = self.__version__
+            return { self.hostname: data }
+        workers = ThreadPool(min(self.options.workers, len(pool_list)))
+        results = []
+        started = {}
         for pool in pool_list:
-            pool_config = pool_list[pool]
-            listen_array = pool_config['listen'].split(':')
-            pool_config['host'] = None
-            pool_config['port'] = None
-            if len(listen_array)>1:
-                pool_config['host'] = listen_array[0]
-                pool_config['port'] = listen_array[1]
-
             for config_key in self.PHP_POOL_CONFIG_KEYS:
                 zbx_key = 'php-fpm.pool.config[{0},{1}]'
                 zbx_key = zbx_key.format(pool, config_key)
-                data[zbx_key] = pool_config[config_key]
-
+                data[zbx_key] = pool_list[pool][config_key]
+            results.append((pool, workers.apply_async(
+                self._poll_pool, (pool, pool_list[pool], started))))
+        ''' Worker threads are daemons: do not wait for hung ones '''
+        workers.close()
+        ''' Ping, then status page, each bounded by the socket timeout '''
+        budget = 2 * self.options.timeout
+        cap = time.time() + budget * len(pool_list)
+        for (pool, result) in results:
             try:
-                if pool_config['port'] is not None:
-                    assert pool_config['host'] is not None
-                    code, headers, out, err = self._get_pool_page(
-                        host=pool_config['host'],
-                        port=pool_config['port'],
-                        url=pool_config['ping.path']
-                    )
-                else:
-                    code, headers, out, err = self._get_pool_page(
-                        connect=pool_config['listen'],
-                        url=pool_config['ping.path']
-                    )
-                code_only = int(code.split()[0])
-                zbx_key = 'php-fpm.pool.ping[{0}]'
-                zbx_key = zbx_key.format(pool)
-                data[zbx_key] = 0
-                if code_only == 200:
-                    data[zbx_key] = 1
-            except:
-                zbx_key = 'php-fpm.pool.ping[{0}]'
-                zbx_key = zbx_key.format(pool)
-                data[zbx_key] = 0
-                pass
-            try:
-                if pool_config['port'] is not None:
-                    assert pool_config['host'] is not None
-                    code, headers, out, err = self._get_pool_page(
-                        host=pool_config['host'],
-                        port=pool_config['port'],
-                        url=pool_config['pm.status_path']
-                    )
-                else:
-                    code, headers, out, err = self._get_pool_page(
-                        connect=pool_config['listen'],
-                        url=pool_config['pm.status_path']
-                    )
-                code_only = int(code.split()[0])
-                zbx_key = 'php-fpm.pool.status[{0}]'
-                zbx_key = zbx_key.format(pool)
-                data[zbx_key] = 0
-                if code_only == 200:
-                  data[zbx_key] = 1
-                  pool_status = simplejson.loads(out)
-                  for key in self.PHP_POOL_STATUS_KEYS:
-                    zbx_key = 'php-fpm.pool.status[{0},{1}]'
-                    zbx_key = zbx_key.format(pool, key.replace(' ', '_'))
-                    data[zbx_key] = pool_status[key]
-            except:
-                zbx_key = 'php-fpm.pool.status[{0}]'
-                zbx_key = zbx_key.format(pool)
-                data[zbx_key] = 0
-                pass
+                data.update(self._wait_pool(pool, result, started, budget, cap))
+            except Exception:
+                data.update(self._get_unreachable_pool_metrics(pool))
+        self._close_fcgi_apps()
         data['php-fpm.zbx_version'] = self.__version__
         return { self.hostname: data }
 
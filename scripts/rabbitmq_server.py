@@ -13,7 +13,6 @@ RabbitMQ monitoring basics:
 '''
 
 import optparse
-import yaml
 import re
 import urllib2
 import json
@@ -21,10 +20,14 @@ import socket
 import sys
 import protobix
 
+yaml = protobix.LazyModule('yaml')
+
 class RabbitMQServer(protobix.SampleProbe):
 
     __version__ = '0.0.9'
 
+    CACHE_TTLS = { 'queues': 30 }
+
     def _call_api(self, path):
         # Call the REST API and convert the results into JSON.
         url = 'http://{0}:{1}/api/{2}'.format(self.options.host, self.options.port, path)
@@ -56,6 +59,10 @@ class RabbitMQServer(protobix.SampleProbe):
         if self.options.host == 'localhost':
             self.options.host = socket.getfqdn()
         self.hostname = self.options.host
+        self.cache = protobix.ProbeCache(
+            'rabbitmq_server', self.CACHE_TTLS,
+            '%s:%s' % (self.options.host, self.options.port)
+        )
         ''' Load config file '''
         with open(self.options.config, 'r') as f:
           config = yaml.load(f)
@@ -67,7 +74,7 @@ class RabbitMQServer(protobix.SampleProbe):
     def _get_discovery(self):
         self.discovery_key = "rabbitmq.queues.discovery"
         data = {self.discovery_key:[]}
-        for queue in self._call_api('queues'):
+        for queue in self.cache.fetch('queues', self._call_api, 'queues'):
             ''' Skip queues matching exclude_patterns '''
             if self.exclude_patterns.match(queue['name']): continue
             try:
@@ -124,7 +131,7 @@ class RabbitMQServer(protobix.SampleProbe):
         data["rabbitmq.connections.recv_oct"] = recv_oct
         data["rabbitmq.connections.send_oct"] = send_oct
 
-        queues_list = self._call_api('queues')
+        queues_list = self.cache.fetch('queues', self._call_api, 'queues')
         for queue in queues_list:
             if self.exclude_patterns.match(queue['name']): continue
             ''' Get global messages count for considered queue '''
@@ -160,6 +167,7 @@ class RabbitMQServer(protobix.SampleProbe):
         return { self.hostname: data }
 
 if __name__ == '__main__':
+    protobix.mark_started()
     ret = RabbitMQServer().run()
     print ret
     sys.exit(ret)
@@ -7,7 +7,8 @@ import optparse
 import socket
 import sys
 import protobix
-import redis
+
+redis = protobix.LazyModule('redis')
 
 class RedisServer(protobix.SampleProbe):
 
@@ -27,6 +28,29 @@ class RedisServer(protobix.SampleProbe):
                 data.update({ "%s%s]" % (prefix, key): value})
         return data
 
+    def _get_info(self, section='default'):
+        """ Fetch INFO in a single round trip, and parse each section
+            apart. Returns parsed sections by lowercase section name """
+        pool = self.redis.connection_pool
+        connection = pool.get_connection('INFO')
+        try:
+            ''' Raw response: INFO response callback would merge sections '''
+            connection.send_command('INFO', section)
+            response = connection.read_response()
+        finally:
+            pool.release(connection)
+        sections = {}
+        lines = []
+        for line in response.splitlines() + ['# ']:
+            if line.startswith('# '):
+                if lines:
+                    sections[name] = redis.client.parse_info('\n'.join(lines))
+                name = line[2:].strip().lower()
+                lines = []
+            elif line:
+                lines.append(line)
+        return sections
+
     def _parse_args(self):
         # Parse the script arguments
         # Common part
@@ -64,10 +88,10 @@ class RedisServer(protobix.SampleProbe):
         """
         data = {}
         section_list = { 'keyspace': 'REDISDB' }
+        info = self._get_info('keyspace')
         for section, lldvalue in section_list.iteritems():
             data[self.discovery_key % section] = []
-            result = self.redis.info(section)
-            if result == {}: result = {}
+            result = info.get(section, {})
             for key, value in result.iteritems():
                 dsc_data = {"{#%s}" % lldvalue: "%s" % key }
                 data[self.discovery_key % section].append(dsc_data)
@@ -89,8 +113,11 @@ class RedisServer(protobix.SampleProbe):
         data = {}
         section_list = [ 'server', 'clients', 'memory', 'persistence',
                          'stats', 'replication', 'cpu', 'cluster', 'keyspace' ]
+        ''' One INFO round trip, fanned out to sections. Default sections
+            are all of the above but commandstats, which is not exported '''
+        info = self._get_info()
         for section in section_list:
-            result = self.redis.info(section)
+            result = info.get(section, {})
             data.update(
                 self._get_data_from_dict(result, ("redis.%s[" % section))
             )
@@ -102,6 +129,7 @@ class RedisServer(protobix.SampleProbe):
         return { self.hostname: data }
 
 if __name__ == '__main__':
+    protobix.mark_started()
     ret = RedisServer().run()
     print ret
     sys.exit(ret)
\ No newline at end of file
@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 
 import optparse
-import yaml
 import protobix
 import simplejson
 import time
@@ -11,12 +10,16 @@ import ssl
 import sys
 from datetime import datetime
 
+yaml = protobix.LazyModule('yaml')
+
 CA_CERTS = "/etc/ssl/certs/ca-certificates.crt"
 
 class SSLEndpointCheck(protobix.SampleProbe):
 
     __version__ = '0.0.9'
 
+    CACHE_TTLS = { 'certificate': 300 }
+
     def _check_expiration(self, cert):
         ''' Return the numbers of day before expiration. False if expired. '''
         if 'notAfter' in cert:
@@ -60,13 +63,15 @@ class SSLEndpointCheck(protobix.SampleProbe):
           config = yaml.load(f)
         self.endpoints = config['endpoints']
         self.discovery_key = 'ssl.certificate.discovery'
+        self.cache = protobix.ProbeCache('ssl_certificates_check',
+                                         self.CACHE_TTLS)
 
     def _get_discovery(self):
         data = { self.discovery_key: [] }
         for endpoint in self.endpoints:
             try:
-                cert = self._get_certificate( host = endpoint,
-                                             port = 443 )
+                cert = self.cache.fetch('certificate', self._get_certificate,
+                                        endpoint, 443)
                 common_name = cert['subjectAltName'][0][1]
                 element = { '{#SSLCERTSERIAL}': common_name + endpoint,
                             '{#SSLCERTNAME}': common_name,
@@ -80,8 +85,8 @@ class SSLEndpointCheck(protobix.SampleProbe):
         data = {}
         for endpoint in self.endpoints:
             try:
-                cert = self._get_certificate( host = endpoint,
-                                             port = 443 )
+                cert = self.cache.fetch('certificate', self._get_certificate,
+                                        endpoint, 443)
                 common_name = cert['subjectAltName'][0][1]
                 zbx_key = "ssl.certificate.expires_in_days[{0},{1}]"
                 zbx_key = zbx_key.format(common_name, endpoint)
@@ -99,6 +104,7 @@ class SSLEndpointCheck(protobix.SampleProbe):
         return { self.hostname: data }
 
 if __name__ == '__main__':
+    protobix.mark_started()
     ret = SSLEndpointCheck().run()
     print ret
     sys.exit(ret)
\ No newline at end of file
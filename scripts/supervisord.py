@@ -28,10 +28,16 @@ class SupervisorServer(protobix.SampleProbe):
         'UNKNOWN': 2
     }
 
-    def _get_infos(self):
+    CACHE_TTLS = { 'status': 30 }
+
+    def _get_status(self):
         proc = subprocess.Popen(['/usr/bin/sudo', '/usr/bin/supervisorctl', 'status'], stdout=subprocess.PIPE)
+        return proc.communicate()[0]
+
+    def _get_infos(self):
+        status = self.cache.fetch('status', self._get_status)
         worker_list = {}
-        for line in iter(proc.stdout.readline,''):
+        for line in status.splitlines():
             proc_fullname = line.split()[0]
             group_name = proc_fullname.split(':')[0]
             proc_name = proc_fullname.split(':')[1]
@@ -66,6 +72,7 @@ class SupervisorServer(protobix.SampleProbe):
     def _init_probe(self):
         self.hostname = socket.getfqdn()
         self.discovery_key = 'supervisord.workers.discovery'
+        self.cache = protobix.ProbeCache('supervisord', self.CACHE_TTLS)
 
     def _get_metrics(self):
         data = {}